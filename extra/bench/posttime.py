@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark for post time parsing in progscrape's HTML scraper.
+
+It builds the HTML page for a large thread, with posts spread over several
+years (so across plenty of DST changes), some of them in the same minute, and
+times turning every post time on it into a Unix time the old way
+(time.mktime(time.strptime(...))) and the new way (progscrape's post_time:
+a hand-written parser for the usual format, with the results kept). It times
+the whole parse of the page both ways as well, since that's what the scraper
+actually does.
+
+Given a /prog/scrape DB, it also checks that both ways agree on the time of
+every post in it, as the HTML interface would have shown it here (so run it
+in the time zone the DB was scraped in).
+"""
+
+import argparse
+import calendar
+import random
+import re
+import sqlite3
+import time
+
+
+header = u'<h3><span class="postnum"><a href=\'javascript:quote(%d,"post1");\'>%d</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">Anonymous</span><span class="postertrip"></span> : <span class="posterdate">%s</span> <span class="id"></span></span></h3>\n<blockquote>\n\t<p>\nbody of post %d<br/>with some more text in it\n\t</p>\n</blockquote>'
+
+postregex = u"""\
+<h3><span class="postnum"><a href='javascript:quote\((?P<id>\d+),"post1"\);'>(?P=id)</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span><span class="postertrip">(?P<trip>.*?)</span> : <span class="posterdate">(?P<time>.*?)</span> <span class="id">.*?</span></span></h3>
+<blockquote>
+\t(?:<div class="aa">)?<p>
+(?P<body>.*?)
+\t</p>(?:</div>)?
+"""
+postregex = re.compile(postregex, re.DOTALL)
+
+
+def old_post_time(s):
+    return int(time.mktime(time.strptime(s, "%Y-%m-%d %H:%M")))
+
+# The same as in progscrape.py
+post_time_regex = re.compile(r'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d)\Z')
+post_times = {}
+max_post_times = 10000
+
+def new_post_time(s):
+    try:
+        return post_times[s]
+    except KeyError:
+        pass
+
+    m = post_time_regex.match(s)
+    if m is not None:
+        y, mon, d, h, mi = map(int, m.groups())
+
+    if m is not None and y >= 1900 and 1 <= mon <= 12 and h < 24 and \
+       mi < 60 and 1 <= d and (d <= 28 or d <= calendar.monthrange(y, mon)[1]):
+        t = int(time.mktime((y, mon, d, h, mi, 0, 0, 1, -1)))
+    else:
+        t = int(time.mktime(time.strptime(s, "%Y-%m-%d %H:%M")))
+
+    if len(post_times) >= max_post_times:
+        post_times.clear()
+    post_times[s] = t
+    return t
+
+def show(t):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+def convert(f, page):
+    return [f(m.group(1)) for m in
+            re.finditer(u'<span class="posterdate">(.*?)</span>', page)]
+
+def parse(f, page):
+    return [(m.group('id'), f(m.group('time')))
+            for m in postregex.finditer(page)]
+
+def bench(f, run, page, repeat):
+    best = None
+    for _ in xrange(repeat):
+        post_times.clear()
+        start = time.time()
+        result = run(f, page)
+        dt = time.time() - start
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Time parsing the post times on the HTML page of a thread of N posts.')
+    parser.add_argument('-n', '--posts', metavar='N', type=int, default=20000,
+                        help='number of posts in the thread (default 20000)')
+    parser.add_argument('-r', '--repeat', metavar='R', type=int, default=3,
+                        help='take the best of R runs (default 3)')
+    parser.add_argument('db', nargs='?',
+                        help='/prog/scrape DB to check every post time of')
+    args = parser.parse_args()
+
+    # A post every couple of hours on average, but in bursts
+    random.seed(0)
+    t, times = int(time.mktime((2009, 1, 1, 0, 0, 0, 0, 1, -1))), []
+    for i in xrange(args.posts):
+        t += random.choice((0, 0, 60, 600, 3600, 7 * 3600, 30 * 3600))
+        times.append(show(t))
+    page = u''.join(header % (i + 1, i + 1, s, i + 1)
+                    for i, s in enumerate(times))
+
+    if args.db is not None:
+        conn = sqlite3.connect(args.db)
+        for s in set(show(t) for t, in conn.execute('select time from posts')):
+            if old_post_time(s) != new_post_time(s):
+                print 'Different: %s (%d, %d)' % (s, old_post_time(s),
+                                                  new_post_time(s))
+        conn.close()
+
+    print '%d posts, %d different times' % (args.posts, len(set(times)))
+    for what, run in (('post times', convert), ('whole page', parse)):
+        t_old, r_old = bench(old_post_time, run, page, args.repeat)
+        t_new, r_new = bench(new_post_time, run, page, args.repeat)
+
+        if r_old != r_new:
+            print 'Results differ!'
+
+        print '%s:' % what
+        print '  strptime:   %8.3fs' % t_old
+        print '  post_time:  %8.3fs' % t_new
+        print '  speedup:    %8.1fx' % (t_old / t_new)
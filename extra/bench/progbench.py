@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+"""
+Offline benchmark for /prog/scrape.
+
+This starts a local stand-in for a Shiichan board, serving a synthetic
+subject.txt, JSON pages (/json/BOARD/ID/RANGE) and HTML pages
+(/read/BOARD/ID/RANGE) of whatever size and latency you like, then scrapes it
+from scratch with progscrape.py for every combination of interface and
+--threads setting asked for. For each run it reports threads/s, posts/s, peak
+RSS and the time spent writing to the DB, and all of it is written to a JSON
+file so runs can be compared over time.
+
+With --incremental, each scrape is followed by a small update: the last post
+of that many threads is taken back out of the DB, and progscrape.py is timed
+catching up. With --errors, that fraction of thread page requests get a 503,
+to see how retrying holds up.
+
+Run it with --serve to just start the server, if you want to point something
+at it by hand.
+"""
+
+import argparse
+import BaseHTTPServer
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import sqlite3
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+
+# The fake board
+
+class Board(object):
+    """A board of `threads' threads with `posts' posts each, every one of
+    them `size' bytes long-ish. Names cycle through the kinds the JSON
+    scraper has to tell apart, including ambiguous tripcodes."""
+
+    def __init__(self, board='/prog/', threads=100, posts=100, size=200):
+        self.board, self.threads, self.posts = board, threads, posts
+        self.filler = ('lorem ipsum dolor sit amet ' * (size / 27 + 1))[:size]
+
+    def thread_ids(self):
+        return [1200000000 + 1000 * i for i in xrange(self.threads)]
+
+    def subject(self):
+        return ''.join('Thread %d<>Anonymous<><>%d<>%d<><>%d\n' %
+                       (tid, tid, self.posts, tid + 60 * self.posts)
+                       for tid in self.thread_ids())
+
+    def post(self, tid, n):
+        """Returns (JSON name, HTML name, HTML trip, time, body)."""
+
+        if n % 7 == 0:
+            json_name, name, trip = 'Name!WokonZwxw2', 'Name', '!WokonZwxw2'
+        elif n % 5 == 0:
+            json_name = name = '<a href="mailto:sage">Anonymous</a>'
+            trip = ''
+        else:
+            json_name, name, trip = 'Anonymous', 'Anonymous', ''
+
+        body = 'Post %d &amp; &gt;&gt;%d<br/>%s' % (n, n - 1, self.filler)
+        return json_name, name, trip, tid + 60 * n, body
+
+    def json_page(self, tid, posts):
+        page = {}
+        for n in posts:
+            json_name, name, trip, t, body = self.post(tid, n)
+            page[str(n)] = {'name': json_name, 'now': str(t), 'com': body}
+        return json.dumps(page)
+
+    def html_page(self, tid, posts):
+        out = ['<html><body><h2>Thread %d</h2>' % tid]
+        for n in posts:
+            json_name, name, trip, t, body = self.post(tid, n)
+            out.append('<h3><span class="postnum"><a href=\'javascript:quote(%d,"post1");\'>%d</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">%s</span><span class="postertrip">%s</span> : <span class="posterdate">%s</span> <span class="id"></span></span></h3>\n<blockquote>\n\t<p>\n%s\n\t</p>\n</blockquote>' %
+                       (n, n, name, trip,
+                        time.strftime('%Y-%m-%d %H:%M', time.localtime(t)),
+                        body))
+        out.append('</body></html>')
+        return ''.join(out)
+
+    def select(self, spec):
+        """Post numbers for a Shiichan post spec like 1-, 5-10 or 1,3,7."""
+
+        posts = []
+        for part in (spec or '1-').split(','):
+            if '-' in part:
+                a, b = part.split('-', 1)
+                posts.extend(xrange(int(a or 1), min(int(b or self.posts),
+                                                     self.posts) + 1))
+            elif part:
+                posts.append(int(part))
+        return [n for n in posts if 1 <= n <= self.posts]
+
+
+def make_handler(board, latency, errors):
+    page_regex = re.compile(r'^/(json|read)%s(\d+)/?([-0-9,]*)$' %
+                            re.escape(board.board))
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if latency > 0:
+                time.sleep(latency)
+
+            m = page_regex.match(self.path)
+            if m is not None and random.random() < errors:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if self.path == board.board + 'subject.txt':
+                body = board.subject()
+            elif m is not None and int(m.group(2)) in board.ids:
+                posts = board.select(m.group(3))
+                if m.group(1) == 'json':
+                    body = board.json_page(int(m.group(2)), posts)
+                else:
+                    body = board.html_page(int(m.group(2)), posts)
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                buf = StringIO()
+                f = gzip.GzipFile(fileobj=buf, mode='wb')
+                f.write(body)
+                f.close()
+                body = buf.getvalue()
+                gzipped = True
+            else:
+                gzipped = False
+
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(board, latency, errors=0.0, port=0):
+    board.ids = set(board.thread_ids())
+    server = Server(('127.0.0.1', port), make_handler(board, latency, errors))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+# Running progscrape
+
+def run(progscrape, address, db, args):
+    cmd = [sys.executable, progscrape, '--base-url', address,
+           '--no-progress-bar'] + args + [db]
+
+    start = time.time()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.stdout.read()
+    pid, status, rusage = os.wait4(p.pid, 0)
+    wall = time.time() - start
+
+    m = re.search(r'Wrote (\d+) posts? to the DB in ([0-9.]+)s', out)
+    errors = re.search(r'Finished with (\d+) error', out)
+
+    return {'wall': wall,
+            'status': status,
+            'peak_rss_kb': rusage.ru_maxrss,
+            'posts_written': int(m.group(1)) if m else None,
+            'db_write_time': float(m.group(2)) if m else None,
+            'errors': int(errors.group(1)) if errors else None,
+            'output': out if status != 0 or errors is None else None}
+
+def knock_back(db, n):
+    """Takes the last post of n threads back out of db, and makes it forget
+    subject.txt, so the next run has a little catching up to do."""
+
+    conn = sqlite3.connect(db)
+    threads = [row[0] for row in
+               conn.execute('select thread from threads order by thread')]
+    threads = threads[::max(len(threads) / max(n, 1), 1)][:n]
+
+    conn.executemany('delete from posts where thread = ? and id = \
+                      (select max(id) from posts where thread = ?)',
+                     [(t, t) for t in threads])
+    conn.executemany('update threads set last_post = 0 where thread = ?',
+                     [(t,) for t in threads])
+    conn.execute("delete from validators where url like '%subject.txt'")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description=
+        'Benchmark /prog/scrape against a local fake Shiichan board.')
+    parser.add_argument('-t', '--threads', metavar='N', default=100,
+                        type=int, help='threads on the board (default 100)')
+    parser.add_argument('-p', '--posts', metavar='N', default=100, type=int,
+                        help='posts per thread (default 100)')
+    parser.add_argument('-s', '--size', metavar='BYTES', default=200, type=int,
+                        help='approximate post size (default 200)')
+    parser.add_argument('-l', '--latency', metavar='SECONDS', default=0.0,
+                        type=float,
+                        help='delay before every response (default 0)')
+    parser.add_argument('-e', '--errors', metavar='RATE', default=0.0,
+                        type=float,
+                        help='fraction of thread pages to fail (default 0)')
+    parser.add_argument('-n', '--incremental', metavar='N', default=0,
+                        type=int,
+                        help='also time catching up on N threads after ' +
+                             'each scrape (default 0)')
+    parser.add_argument('-i', '--interfaces', default='json,html',
+                        help='interfaces to scrape (default json,html)')
+    parser.add_argument('-w', '--workers', default='1,8,auto',
+                        help='--threads values to use (default 1,8,auto)')
+    parser.add_argument('-a', '--args', default='',
+                        help='extra arguments for progscrape.py')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        default='progbench.json',
+                        help='where to write results (default progbench.json)')
+    parser.add_argument('--progscrape', metavar='FILE',
+                        default=os.path.join(here, '..', '..', 'progscrape.py'),
+                        help='progscrape.py to benchmark')
+    parser.add_argument('--port', type=int, default=0,
+                        help='port to serve on (default: any free port)')
+    parser.add_argument('--serve', action='store_true',
+                        help="just run the server until interrupted")
+    args = parser.parse_args()
+
+    board = Board(threads=args.threads, posts=args.posts, size=args.size)
+    server = serve(board, args.latency, args.errors, args.port)
+    address = '127.0.0.1:%d' % server.server_address[1]
+
+    if args.serve:
+        print 'Serving %s on http://%s' % (board.board, address)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    tmp = tempfile.mkdtemp(prefix='progbench')
+    results = []
+
+    try:
+        for interface in args.interfaces.split(','):
+            for workers in args.workers.split(','):
+                db = os.path.join(tmp, '%s-%s.db' % (interface, workers))
+                r = run(args.progscrape, address, db,
+                        ['--' + interface, '--threads', workers] +
+                        shlex.split(args.args))
+
+                r.update({'interface': interface, 'workers': workers,
+                          'threads_per_s': args.threads / r['wall'],
+                          'posts_per_s': args.threads * args.posts / r['wall']})
+                results.append(r)
+
+                print '%-4s --threads %-4s %6.2fs %8.1f threads/s %9.1f posts/s' \
+                      ' %7d KiB RSS %6.2fs writing' % \
+                      (interface, workers, r['wall'], r['threads_per_s'],
+                       r['posts_per_s'], r['peak_rss_kb'],
+                       r['db_write_time'] or 0.0)
+                if r['output'] is not None:
+                    print r['output']
+
+                if args.incremental > 0:
+                    knock_back(db, args.incremental)
+                    i = run(args.progscrape, address, db,
+                            ['--' + interface, '--threads', workers] +
+                            shlex.split(args.args))
+                    r['incremental'] = i
+
+                    print '%-4s --threads %-4s %6.2fs to catch up on %d ' \
+                          'thread%s' % (interface, workers, i['wall'],
+                                        args.incremental,
+                                        '' if args.incremental == 1 else 's')
+                    if i['output'] is not None:
+                        print i['output']
+    finally:
+        shutil.rmtree(tmp)
+
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.time(),
+                   'board': {'threads': args.threads, 'posts': args.posts,
+                             'size': args.size, 'latency': args.latency,
+                             'errors': args.errors},
+                   'incremental': args.incremental,
+                   'args': args.args,
+                   'results': results}, f, indent=2)
+
+    print 'Results written to %s.' % args.output
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+"""
+Benchmark for progscrub, the HTML scrubber /prog/scrape uses to get plain text
+out of post bodies and names.
+
+It scrubs every post body and author in a /prog/scrape DB the old way (a
+separate pass for line breaks, quotes, tags, numeric and named character
+references, the last with a regex alternating over every entity name) and
+with progscrub.scrub, checks that both come out exactly the same, and reports
+posts/s for each.
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+from htmlentitydefs import name2codepoint
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', '..'))
+
+import progscrub
+
+
+def old_scrub(s, regices=[re.compile('<.*?>'),
+                          re.compile(r'&#(\d+);'),
+                          re.compile('&(%s);' % '|'.join(name2codepoint))]):
+    if s is None:
+        return u''
+    s = s.replace('<br/>', '\n')
+    s = s.replace("<span class='quote'>", '> ')
+    s = regices[0].sub('', s)
+    s = regices[1].sub(lambda m: unichr(int(m.group(1))) \
+                                 if int(m.group(1)) <= 0x10ffff \
+                                 else m.group(0), s)
+    s = regices[2].sub(lambda m: unichr(name2codepoint[m.group(1)]), s)
+    return s
+
+# Not often seen in posts, but easy to get wrong: references that make other
+# references once decoded, and things that look like references
+tricky = [u'&#38;amp;', u'&amp&#59;', u'&&#97;mp;', u'&lt&#59;b>', u'&#38;#59;',
+          u'&amp;lt;', u'&#38;&#38;lt;', u'&#0038;amp;', u'&ampx;', u'&AMP;',
+          u'&#1114112;', u'&#x41;', u'<b>&</b>amp;', u'&<i></i>amp;',
+          u'<a\nhref>&nbsp;']
+
+def bench(f, posts, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for body, author in posts:
+            f(body)
+            f(author)
+        dt = time.time() - start
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Time scrubbing every post in a /prog/scrape DB, old and new.')
+    parser.add_argument('-r', '--repeat', metavar='R', type=int, default=3,
+                        help='take the best of R runs (default 3)')
+    parser.add_argument('db', help='/prog/scrape DB file')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    posts = conn.execute('select body, author from posts').fetchall()
+    conn.close()
+
+    different = [s for post in posts + [(s, None) for s in tricky]
+                   for s in post
+                 if old_scrub(s) != progscrub.scrub(s)]
+    for s in different[:10]:
+        print 'Different: %r' % s
+        print '      old: %r' % old_scrub(s)
+        print '      new: %r' % progscrub.scrub(s)
+
+    old = bench(old_scrub, posts, args.repeat)
+    new = bench(progscrub.scrub, posts, args.repeat)
+
+    print '%d posts, %d with different output.' % (len(posts), len(different))
+    print 'old: %10.0f posts/s' % (len(posts) / old)
+    print 'new: %10.0f posts/s (%.2fx)' % (len(posts) / new, old / new)
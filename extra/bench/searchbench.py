@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+"""
+Benchmark for progsearch.py's search backends.
+
+This takes a copy of a /prog/scrape DB, builds both a Whoosh index and an FTS5
+table for it, and reports how long each took to build and how much space it
+takes up. It then runs each query a number of times against both, sorted by
+relevance and by time, and reports the median time per query. Everything is
+also written to a JSON file so runs can be compared over time.
+
+Queries are passed to both backends as they are, so stick to the syntax they
+have in common: words, "phrases" and OR.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+import progsearch
+
+
+def du(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f))
+               for d, dirs, files in os.walk(path) for f in files)
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    f(*args, **kwargs)
+    return time.time() - start
+
+def median(xs):
+    xs = sorted(xs)
+    return xs[len(xs) / 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Compare the Whoosh and FTS5 backends of progsearch.py.')
+    parser.add_argument('-q', '--queries',
+                        default='sicp,lisp,"read sicp",haskell OR lisp',
+                        help='comma-separated queries to run ' +
+                             '(default sicp,lisp,"read sicp",haskell OR lisp)')
+    parser.add_argument('-n', '--repeat', metavar='N', default=5, type=int,
+                        help='run every query N times (default 5)')
+    parser.add_argument('-l', '--limit', metavar='N', default=10, type=int,
+                        help='results per query (default 10)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='processes to build the Whoosh index with')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        default='searchbench.json',
+                        help='where to write results (default searchbench.json)')
+    parser.add_argument('db', help='/prog/scrape DB file')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='searchbench')
+    results = {'time': time.time(), 'db': args.db, 'backends': {}}
+
+    try:
+        db = os.path.join(tmp, 'bench.db')
+        shutil.copy(args.db, db)
+        idir = os.path.join(tmp, 'index')
+        os.mkdir(idir)
+
+        conn = sqlite3.connect(db)
+        posts = conn.execute('select count(*) from posts').fetchone()[0]
+        conn.close()
+        results['posts'] = posts
+
+        size = du(db)
+        fts = {'build': timed(progsearch.build_fts, db, optimize=True)}
+        fts['size'] = du(db) - size
+
+        whoosh = {'build': timed(progsearch.build_index, db, idir, 'bench.db',
+                                 args.jobs)}
+        whoosh['size'] = du(idir)
+
+        searches = {'whoosh': lambda q, sort:
+                        progsearch.search_whoosh(idir, 'bench.db', q, sort,
+                                                 False, args.limit),
+                    'fts5': lambda q, sort:
+                        progsearch.search_fts(db, q, sort, False, args.limit)}
+
+        print
+        print '%-8s %10s %12s' % ('backend', 'build (s)', 'size (KiB)')
+        for name, r in (('whoosh', whoosh), ('fts5', fts)):
+            print '%-8s %10.2f %12d' % (name, r['build'], r['size'] / 1024)
+            r['queries'] = {}
+            results['backends'][name] = r
+
+        print
+        print '%-24s %-5s %12s %12s %8s' % ('query', 'sort', 'whoosh (ms)',
+                                            'fts5 (ms)', 'results')
+        for q in args.queries.split(','):
+            q = q.decode('utf8')
+            for sort in ('rel', 'time'):
+                times = {}
+                for name, search in searches.items():
+                    times[name] = median([timed(list, search(q, sort))
+                                          for i in xrange(args.repeat)])
+                    results['backends'][name]['queries']['%s/%s' % (q, sort)] = \
+                        times[name]
+                hits = len(list(searches['fts5'](q, sort)))
+
+                print '%-24s %-5s %12.2f %12.2f %8d' % \
+                      (q, sort, times['whoosh'] * 1000, times['fts5'] * 1000,
+                       hits)
+    finally:
+        shutil.rmtree(tmp)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print
+    print 'Results written to %s.' % args.output
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark for tripcode verification in progscrape's JSON scraper.
+
+It builds the HTML page for a thread full of posts with ambiguous tripcodes
+and times looking up every one of those posts' headers in it, the old way
+(compiling a regex per post and searching the whole page with it) and the
+new way (parsing every header on the page into a dict once).
+"""
+
+import argparse
+import re
+import time
+
+
+header = u'<h3><span class="postnum"><a href=\'javascript:quote(%d,"post1");\'>%d</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">Name</span><span class="postertrip">!WokonZwxw2</span> : <span class="posterdate">2010-09-01 12:00</span> <span class="id"></span></span></h3>\n<blockquote>\n\t<p>\nbody of post %d<br/>with some more text in it\n\t</p>\n</blockquote>'
+
+old_regex = u'<h3><span class="postnum"><a href=\'javascript:quote\(%s,"post1"\);\'>%s</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span> ?<span class="postertrip">(?P<trip>.*?)</span>'
+
+new_regex = u'<h3><span class="postnum"><a href=\'javascript:quote\((?P<id>\d+),"post1"\);\'>(?P=id)</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span> ?<span class="postertrip">(?P<trip>.*?)</span>'
+new_regex = re.compile(new_regex, re.DOTALL)
+
+
+def verify_old(hp, tripv):
+    trips = {}
+    for post in tripv:
+        m = re.compile(old_regex % (post, post), re.DOTALL).search(hp)
+        trips[post] = m.group('author'), m.group('trip')
+    return trips
+
+def verify_new(hp, tripv):
+    htrips = {}
+    for m in new_regex.finditer(hp):
+        htrips[m.group('id')] = m.group('author', 'trip')
+    return dict((post, htrips[post]) for post in tripv)
+
+def bench(f, hp, tripv, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = f(hp, tripv)
+        dt = time.time() - start
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=
+        'Time tripcode verification on a thread of N ambiguous posts.')
+    parser.add_argument('-n', '--posts', metavar='N', type=int, default=3000,
+                        help='number of posts in the thread (default 3000)')
+    parser.add_argument('-r', '--repeat', metavar='R', type=int, default=3,
+                        help='take the best of R runs (default 3)')
+    args = parser.parse_args()
+
+    hp = ''.join(header % (i, i, i) for i in xrange(1, args.posts + 1))
+    hp = hp.encode('utf-8')
+    tripv = map(str, xrange(1, args.posts + 1))
+
+    t_old, r_old = bench(verify_old, hp, tripv, args.repeat)
+    t_new, r_new = bench(verify_new, hp, tripv, args.repeat)
+
+    if r_old != r_new:
+        print 'Results differ!'
+
+    print '%d ambiguous posts, %d byte page' % (args.posts, len(hp))
+    print '  regex per post: %8.3fs' % t_old
+    print '  single pass:    %8.3fs' % t_new
+    print '  speedup:        %8.1fx' % (t_old / t_new)
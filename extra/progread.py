@@ -1,29 +1,24 @@
 #!/usr/bin/python
 
+import codecs
 import os
-import re
+import signal
 import sqlite3
+import subprocess
 import sys
 import textwrap
 import time
-from htmlentitydefs import name2codepoint
 
+try:
+    import progdb
+    from progscrub import scrub
+except ImportError:
+    # They live next to progscrape.py
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 '..'))
+    import progdb
+    from progscrub import scrub
 
-def unescape(s):
-    if isinstance(s, int):
-        return s
-
-    if s is None:
-        return u''
-
-    s = s.replace('<br/>', '\n')
-    s = re.sub('<[^<]+?>', '', s)
-    s = re.sub(r'&#(\d+);', lambda m: unichr(int(m.group(1))), s) 
-    s = re.sub('&(%s);' % '|'.join(name2codepoint),
-               lambda m: unichr(name2codepoint[m.group(1)]),
-               s)
-        
-    return s
 
 def termwidth():
     try:
@@ -45,15 +40,82 @@ def termwidth():
 
     return int(os.environ.get('COLUMNS', 80))
 
+def parse_posts(specs):
+    """Turns post specs like 5, 1-50, 100- or 1-50,100 into a sorted list of
+    (first, last) ranges, where last is None if there's no end to it.
+    Ranges that overlap or touch are merged."""
+
+    ranges = []
+    for spec in specs:
+        for part in spec.split(','):
+            if part == '':
+                continue
+            if '-' in part:
+                first, last = part.split('-', 1)
+                ranges.append((int(first or 1), int(last) if last else None))
+            else:
+                ranges.append((int(part), int(part)))
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and (merged[-1][1] is None or first <= merged[-1][1] + 1):
+            if merged[-1][1] is not None and (last is None or
+                                              last > merged[-1][1]):
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+# How many ranges to ask for in one query. SQLite only takes so many terms
+# in an expression, and so many parameters.
+ranges_per_query = 250
+
+def select_posts(c, thread, ranges):
+    """Queries for the posts of thread in any of the ranges (or all of them,
+    if there are none), a few hundred ranges at a time, and yields them in
+    order as they come, so they can be displayed right away."""
+
+    for i in xrange(0, max(len(ranges), 1), ranges_per_query):
+        where, params, ids = [], [thread], []
+        for first, last in ranges[i:i + ranges_per_query]:
+            if first == last:
+                ids.append(first)
+            elif last is None:
+                where.append('id >= ?')
+                params.append(first)
+            else:
+                where.append('id between ? and ?')
+                params.extend((first, last))
+
+        # Single posts all go in one term
+        if ids:
+            where.append('id in (%s)' % ','.join('?' * len(ids)))
+            params.extend(ids)
+
+        query = 'select * from posts where thread = ?'
+        if where:
+            query += ' and (%s)' % ' or '.join(where)
+        for post in c.execute(query + ' order by id', params):
+            yield post
+
 def display(thread, posts):
     w = termwidth() - 8
  
-    print unescape(thread[1])
+    print scrub(thread[1])
     print
 
     for post in posts:
-        post = dict(zip(['_', 'id', 'name', 'email', 'trip', 'time', 'body'],
-                        map(unescape, post)))
+        post = dict(zip(['_', 'id', 'name', 'email', 'trip', 'time', 'body',
+                         'plain_body', 'plain_name'],
+                        post))
+
+        # Use the plaintext /prog/scrape stored, if it's there
+        if post.get('plain_body') is None:
+            post['plain_body'] = scrub(post['body'])
+            post['plain_name'] = scrub(post['name'])
+        post['body'], post['name'] = post['plain_body'], post['plain_name']
+        post['email'], post['trip'] = scrub(post['email']), scrub(post['trip'])
+
         try:
             post['time'] = time.ctime(post['time'])
         except:
@@ -65,7 +127,7 @@ def display(thread, posts):
             if line == '':
                 print '    '
 
-            for l in textwrap.wrap(re.sub('<[^<]+?>', '', line), w):
+            for l in textwrap.wrap(line, w):
                 print '    %s' % l
 
         print
@@ -73,21 +135,31 @@ def display(thread, posts):
 
 usage = """\
 \033[1mUSAGE\033[0m
-    %s [\033[4mDB\033[0m] \033[4mTHREAD\033[0m [\033[4mPOST\033[0m...]
+    %s [\033[1m-p\033[0m] [\033[4mDB\033[0m] \033[4mTHREAD\033[0m [\033[4mPOSTS\033[0m...]
 
 \033[1mARGUMENTS\033[0m
+    \033[1m-p\033[0m, \033[1m--pager\033[0m
+        Show the posts in \033[1m$PAGER\033[0m. (default: \033[7mless\033[0m)
+
     \033[4mDB\033[0m
         SQLite3 database file produced by \033[1mprogscrape(1)\033[0m. (default: \033[7mprog.db\033[0m)
 
     \033[4mTHREAD\033[0m
         Numerical thread ID.
 
-    \033[4mPOST\033[0m
-        Single Post ID.
+    \033[4mPOSTS\033[0m
+        Post IDs, or ranges of them like \033[7m1-50\033[0m or \033[7m100-\033[0m, separated by commas
+        or spaces. (default: the whole thread)
 """ % sys.argv[0]
 
 sys.argv = sys.argv[1:]
 
+pager = None
+for flag in ('-p', '--pager'):
+    if flag in sys.argv:
+        sys.argv.remove(flag)
+        pager = os.environ.get('PAGER', 'less')
+
 try:
     db = 'prog.db'
     try:
@@ -99,17 +171,27 @@ try:
     thread = int(sys.argv[0])
     sys.argv = sys.argv[1:]
 
-    posts = map(int, sys.argv)
+    posts = parse_posts(sys.argv)
 
 except:
     print usage
     sys.exit(1)
 
+# Quitting the pager (or head, or whatever) early isn't an error
+signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+if pager is not None:
+    pager = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE)
+    sys.stdout = pager.stdin
+
+if getattr(sys.stdout, 'encoding', None) is None:
+    sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
+
 try:
     if not os.path.isfile(db):
         raise sqlite3.OperationalError("Penis.")
 
-    conn = sqlite3.connect(db)
+    conn = progdb.connect(db)
     c = conn.cursor()
 
     th = c.execute('select * from threads where thread = ?', [thread]).fetchone()
@@ -117,16 +199,17 @@ try:
         print 'Error: Invalid thread ID.'
         sys.exit(3)
 
-    if posts != []:
-        po = []
-        for post in posts:
-            po.append(c.execute('select * from posts where thread = ? and id = ?',
-                                (thread, post)).fetchone())
-    else:
-        po = c.execute('select * from posts where thread = ?', [thread]).fetchall()
+    display(th, select_posts(c, thread, posts))
 
-    display(th, po)
-
-except sqlite3.OperationalError:
-    print 'Error: Not a DB:', db
+except sqlite3.DatabaseError, e:
+    if not os.path.isfile(db) or \
+       str(e).startswith(('file is not a database', 'file is encrypted',
+                          'no such table')):
+        print 'Error: Not a DB:', db
+    else:
+        print 'Error:', e
     sys.exit(2)
+
+if pager is not None:
+    sys.stdout.close()
+    pager.wait()
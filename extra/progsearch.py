@@ -1,74 +1,463 @@
 #!/usr/bin/python
 
+from __future__ import with_statement
+
 import argparse
 import datetime
+import json
+import multiprocessing
 import os
-import re
+import shutil
 import sqlite3
 import sys
 import textwrap
 import time
-from htmlentitydefs import name2codepoint
 
-import whoosh.fields
-import whoosh.index
-import whoosh.qparser
+try:
+    import whoosh.fields
+    import whoosh.index
+    import whoosh.qparser
+except ImportError:
+    whoosh = None
+
+try:
+    import progdb
+    from progscrub import scrub
+except ImportError:
+    # They live next to progscrape.py
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 '..'))
+    import progdb
+    from progscrub import scrub
+
+def schema():
+    return whoosh.fields.Schema(thread=whoosh.fields.STORED,
+                                post=whoosh.fields.STORED,
+                                author=whoosh.fields.STORED,
+                                trip=whoosh.fields.STORED,
+                                email=whoosh.fields.STORED,
+                                time=whoosh.fields.DATETIME(stored=True),
+                                body=whoosh.fields.TEXT(stored=True))
+
+def parts_dir(idir, indexname):
+    """Where an unfinished build keeps its partial indices."""
+    return os.path.join(idir, indexname + '.parts')
+
+def write_json(path, obj):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.rename(path + '.tmp', path)
+
+def post_time(timestamp):
+    try:
+        timestamp = float(timestamp)
+    except:  # Shiichan is lovely.
+        timestamp = 0.0
+    return datetime.datetime.fromtimestamp(timestamp)
+
+# Posts as add_post wants them
+post_columns = 'thread, id, author, email, trip, time, body, \
+                plain_body, plain_author'
+
+def add_plaintext_columns(conn):
+    """/prog/scrape stores plaintext bodies and authors along with posts. DBs
+    from older versions don't have the columns for that yet; posts without
+    plaintext are scrubbed as they're read."""
+
+    columns = [c[1] for c in conn.execute('pragma table_info(posts)')]
+    for column in ('plain_body', 'plain_author'):
+        if column not in columns:
+            conn.execute('alter table posts add column %s TEXT' % column)
+    conn.commit()
+
+def add_post(writer, (thread, post, author, email, trip, timestamp, body,
+                      plain_body, plain_author)):
+    if plain_body is None:
+        plain_body, plain_author = scrub(body), scrub(author)
+
+    writer.add_document(thread=thread, post=post,
+                        author=plain_author, trip=trip, email=email,
+                        time=post_time(timestamp), body=plain_body)
+
+def track_changes(conn):
+    """Sets up the tables /prog/scrape uses to keep track of posts that
+    aren't in the index yet. Once there's a row in index_state, every post
+    written to the DB is listed in unindexed until it's been indexed."""
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS unindexed (
+            thread INTEGER,
+            id INTEGER,
+            PRIMARY KEY (thread, id)
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS index_state (
+            indexname TEXT PRIMARY KEY,
+            generation INTEGER,
+            last_change INTEGER
+        )""")
+    columns = [c[1] for c in conn.execute('pragma table_info(index_state)')]
+    if 'last_change' not in columns:
+        conn.execute('alter table index_state add column last_change INTEGER')
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS log_posts AFTER INSERT ON posts
+        WHEN EXISTS (SELECT 1 FROM index_state)
+        BEGIN
+            INSERT OR REPLACE INTO unindexed VALUES (new.thread, new.id);
+        END""")
+
+def forget_unindexed(conn, indexname, last_change):
+    """Deletes the rows of unindexed up to last_change. Their rowids can be
+    reused after that, so last_change has to go too."""
+
+    conn.execute('delete from unindexed where rowid <= ?', (last_change,))
+    conn.execute('update index_state set last_change = 0 where indexname = ?',
+                 (indexname,))
+
+def build_index(db, idir, indexname, procs=None):
+    """Builds the index in parallel. Posts are split into partitions by
+    thread, which are scrubbed and indexed in separate processes, each into
+    its own index in parts_dir(), and finally merged. If a build is
+    interrupted, calling this again picks up where it left off.
+
+    The build covers the posts that were in the DB when it started, up to
+    the rowid written down in the plan; posts written after that are left
+    to update_index, which finds them in unindexed, so none is indexed
+    twice."""
 
-def build_index(db, idir, indexname):
     start = time.time()
-    print 'Building index %s in %s... ' % (indexname, idir),
+    pdir = parts_dir(idir, indexname)
+    plan = os.path.join(pdir, 'plan.json')
+
+    conn = progdb.connect(db)
+    add_plaintext_columns(conn)
+    conn.close()
+
+    if os.path.exists(plan):
+        print 'Resuming index %s in %s... ' % (indexname, idir),
+        with open(plan) as f:
+            plan = json.load(f)
+        if isinstance(plan, list):
+            # From before plans had a last post, so it's open ended
+            plan = {'partitions': plan, 'last_post': None}
+        partitions, last_post = plan['partitions'], plan['last_post']
+    else:
+        print 'Building index %s in %s... ' % (indexname, idir),
+        if not os.path.exists(pdir):
+            os.mkdir(pdir)
+
+        # Anything written from here on will be picked up by update_index,
+        # and not by the build: both happen in one transaction, so no post
+        # can slip in between
+        conn = progdb.connect(db)
+        track_changes(conn)
+        conn.execute('delete from unindexed')
+        conn.execute('insert or replace into index_state values (?, 0, 0)',
+                     (indexname,))
+        last_post = conn.execute('select max(rowid) from posts') \
+                        .fetchone()[0] or 0
+        conn.commit()
+        conn.close()
+
+        partitions = partition(db, (procs or multiprocessing.cpu_count()) * 4)
+        write_json(plan, {'partitions': partitions, 'last_post': last_post})
     sys.stdout.flush()
 
-    schema = whoosh.fields.Schema(thread=whoosh.fields.STORED,
-                                  post=whoosh.fields.STORED,
-                                  author=whoosh.fields.STORED,
-                                  trip=whoosh.fields.STORED,
-                                  email=whoosh.fields.STORED,
-                                  time=whoosh.fields.DATETIME(stored=True),
-                                  body=whoosh.fields.TEXT(stored=True))
-    ix = whoosh.index.create_in(idir, schema, indexname=indexname)
+    pool = multiprocessing.Pool(procs)
+    pool.map(build_partition, [(db, pdir, n, lo, hi, last_post)
+                               for n, (lo, hi) in enumerate(partitions)], 1)
+    pool.close()
+
+    # Merge the partitions, in order
+    ix = whoosh.index.create_in(idir, schema(), indexname=indexname)
     writer = ix.writer()
+    for n in xrange(len(partitions)):
+        part = whoosh.index.open_dir(pdir, indexname='part%d' % n)
+        reader = part.reader()
+        writer.add_reader(reader)
+        reader.close()
+    writer.commit()
+    shutil.rmtree(pdir)
 
-    conn = sqlite3.connect(db)
-    cur = conn.cursor()
-    cur.execute('select * from posts')
+    conn = progdb.connect(db)
+    conn.execute('update index_state set generation = ?, last_change = 0 \
+                  where indexname = ?', (ix.latest_generation(), indexname))
+    conn.commit()
+    conn.close()
+
+    dt = int(time.time() - start)
+    print 'done. (%dm%02ds)' % (dt / 60, dt % 60)
+
+def update_index(db, idir, indexname):
+    """Adds posts written to the DB since the index was last committed, in
+    the same steps /prog/scrape takes when it's indexing: index_state is
+    told which generation the commit will make and how much of unindexed it
+    covers before committing, and those rows are deleted afterwards, so that
+    either can be interrupted at any point and the other will know what's
+    been indexed."""
+
+    start = time.time()
+    ix = whoosh.index.open_dir(idir, indexname=indexname)
+    conn = progdb.connect(db)
+    add_plaintext_columns(conn)
+    track_changes(conn)
+
+    state = conn.execute('select generation, last_change from index_state \
+                          where indexname = ?', (indexname,)).fetchone()
 
-    tags = re.compile('<.*?>')
+    if state is None:
+        print >>sys.stderr, "Posts written to %s weren't being tracked; " \
+                            "they will be from now on." % db
+        conn.execute('delete from unindexed')
+        conn.execute('insert into index_state values (?, ?, 0)',
+                     (indexname, ix.latest_generation()))
+    elif ix.latest_generation() >= state[0]:
+        forget_unindexed(conn, indexname, state[1])
+    conn.commit()
 
-    for thread, post, author, email, trip, timestamp, body in cur:
-        
-        author = scrub(author)
-        body = scrub(body)
+    last_change = conn.execute('select max(rowid) from unindexed').fetchone()[0]
+    if last_change is None:
+        print >>sys.stderr, 'Index for %s is up to date.' % indexname
+        conn.close()
+        return
 
-        try:
-            timestamp = float(timestamp)
-        except:  # Shiichan is lovely.
-            timestamp = 0.0
-        timestamp = datetime.datetime.fromtimestamp(timestamp)
+    print 'Updating index %s in %s... ' % (indexname, idir),
+    sys.stdout.flush()
 
-        writer.add_document(thread=thread, post=post,
-                            author=author, trip=trip, email=email,
-                            time=timestamp, body=body)
+    writer, added = ix.writer(), 0
+    for row in conn.execute('select %s from unindexed natural join posts \
+                             where unindexed.rowid <= ? \
+                             order by thread, id' % post_columns,
+                            (last_change,)):
+        add_post(writer, row)
+        added += 1
 
+    conn.execute('update index_state set generation = ?, last_change = ? \
+                  where indexname = ?',
+                 (ix.latest_generation() + 1, last_change, indexname))
+    conn.commit()
     writer.commit()
+    forget_unindexed(conn, indexname, last_change)
+    conn.commit()
     conn.close()
 
     dt = int(time.time() - start)
-    print 'done. (%dm%02ds)' % (dt / 60, dt % 60)
+    print 'done. (%d posts, %dm%02ds)' % (added, dt / 60, dt % 60)
+
+def partition(db, n):
+    """Splits the threads in db into at most n ranges of about as many posts
+    each, as a list of [first thread, last thread]. The first and last
+    ranges are open ended, so they take in any thread."""
+
+    conn = progdb.connect(db)
+    counts = conn.execute('select thread, count(*) from posts \
+                           group by thread order by thread').fetchall()
+    conn.close()
+
+    total = sum(c for t, c in counts)
+    partitions, lo, acc = [], None, 0
+
+    for thread, c in counts:
+        if lo is None:
+            lo = thread
+        acc += c
+        if acc >= total * (len(partitions) + 1) / n:
+            partitions.append([lo, thread])
+            lo = None
+
+    if lo is not None:
+        partitions.append([lo, None])
+    elif partitions:
+        partitions[-1][1] = None
+    else:
+        partitions.append([0, None])
+
+    partitions[0][0] = None
+    return partitions
+
+def build_partition(args, every=10000):
+    """Indexes posts in threads lo through hi, up to rowid last_post, into
+    index partN in pdir, committing every so many posts. Before each commit,
+    the checkpoint file records the last post that commit will include and
+    the generation it will have, so on resuming we know which of the last
+    two checkpoints made it into the index."""
+
+    db, pdir, n, lo, hi, last_post = args
+    name, checkpoint = 'part%d' % n, os.path.join(pdir, 'part%d.json' % n)
 
-def scrub(s, regices=[re.compile('<.*?>'),
-                      re.compile(r'&#(\d+);'),
-                      re.compile('&(%s);' % '|'.join(name2codepoint))]):
-    if s is None:
-        return u''
-    s = s.replace('<br/>', '\n')
-    s = s.replace("<span class='quote'>", '> ')
-    s = regices[0].sub('', s)
-    s = regices[1].sub(lambda m: unichr(int(m.group(1))) \
-                                 if int(m.group(1)) <= 0x10ffff \
-                                 else m.group(0), s)
-    s = regices[2].sub(lambda m: unichr(name2codepoint[m.group(1)]), s)
-    return s
+    # Without a checkpoint, the index can't have anything in it yet
+    if whoosh.index.exists_in(pdir, indexname=name) and \
+       os.path.exists(checkpoint):
+        ix = whoosh.index.open_dir(pdir, indexname=name)
+        with open(checkpoint) as f:
+            ckpt = json.load(f)
+    else:
+        ix = whoosh.index.create_in(pdir, schema(), indexname=name)
+        ckpt = {'done': None, 'pending': None}
+        write_json(checkpoint, ckpt)
+
+    if ckpt['pending'] and ix.latest_generation() >= ckpt['pending'][2]:
+        ckpt['done'] = ckpt['pending']
+    ckpt['pending'] = None
+
+    if ckpt['done'] is not None and ckpt['done'][0] is None:
+        # This partition is finished
+        return
+
+    conn = progdb.connect(db)
+    cur = conn.cursor()
+
+    where, params = [], []
+    if last_post is not None:
+        where.append('rowid <= ?')
+        params.append(last_post)
+    if lo is not None:
+        where.append('thread >= ?')
+        params.append(lo)
+    if hi is not None:
+        where.append('thread <= ?')
+        params.append(hi)
+    if ckpt['done'] is not None:
+        where.append('(thread > ? or thread = ? and id > ?)')
+        params.extend([ckpt['done'][0], ckpt['done'][0], ckpt['done'][1]])
+
+    cur.execute('select %s from posts %s order by thread, id' %
+                (post_columns, 'where ' + ' and '.join(where) if where else ''),
+                params)
+
+    writer, added = ix.writer(), 0
+
+    for row in cur:
+        add_post(writer, row)
+        added += 1
+
+        if added % every == 0:
+            ckpt['pending'] = [row[0], row[1], ix.latest_generation() + 1]
+            write_json(checkpoint, ckpt)
+            writer.commit(merge=False)
+            ckpt['done'], ckpt['pending'] = ckpt['pending'], None
+            write_json(checkpoint, ckpt)
+            writer = ix.writer()
+
+    # A checkpoint without a thread means we're done
+    ckpt['pending'] = [None, None, ix.latest_generation() + 1]
+    write_json(checkpoint, ckpt)
+    writer.commit(merge=False)
+    write_json(checkpoint, {'done': ckpt['pending'], 'pending': None})
+
+    conn.close()
+
+def search_whoosh(idir, indexname, query, sort, reverse, limit):
+    ix = whoosh.index.open_dir(idir, indexname=indexname)
+    with ix.searcher() as searcher:
+        qparse = whoosh.qparser.QueryParser('body', ix.schema)
+        for result in searcher.search(qparse.parse(query),
+                                      sortedby=sort if sort != 'rel' else None,
+                                      reverse=reverse,
+                                      limit=limit):
+            yield result
+
+# The FTS5 backend keeps scrubbed bodies and authors in a full-text table in
+# the DB itself, with the same rowids as the posts they belong to. Triggers
+# take care of adding the plaintext of posts as they're written, and deleting
+# rows for posts that are replaced or deleted. Posts at the end of the posts
+# table without a row mean that either the build was interrupted, or something
+# wrote posts without plaintext; either way, build_fts catches up.
+
+def fts_outdated(conn):
+    """True if posts_fts is missing or behind the posts table."""
+
+    if conn.execute("select 1 from sqlite_master where name = 'posts_fts'") \
+           .fetchone() is None:
+        return True
+
+    return conn.execute('select max(rowid) from posts').fetchone()[0] > \
+           (conn.execute('select max(rowid) from posts_fts').fetchone()[0] or 0)
+
+def build_fts(db, optimize=False, every=10000):
+    """Creates posts_fts if need be, and adds every post that isn't in it
+    yet, committing every so many posts. This works the same whether it's
+    building it from scratch, carrying on after being interrupted, or
+    catching up with posts that were written without plaintext."""
+
+    start = time.time()
+    conn = progdb.connect(db)
+
+    print 'Updating full-text table in %s... ' % db,
+    sys.stdout.flush()
+
+    add_plaintext_columns(conn)
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(body, author)
+        """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS fts_insert AFTER INSERT ON posts
+        WHEN new.plain_body IS NOT NULL
+        BEGIN
+            INSERT INTO posts_fts (rowid, body, author)
+            VALUES (new.rowid, new.plain_body, new.plain_author);
+        END""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS fts_replace BEFORE INSERT ON posts
+        BEGIN
+            DELETE FROM posts_fts WHERE rowid = (SELECT rowid FROM posts
+                                                 WHERE thread = new.thread
+                                                 AND id = new.id);
+        END""")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS fts_delete AFTER DELETE ON posts
+        BEGIN
+            DELETE FROM posts_fts WHERE rowid = old.rowid;
+        END""")
+    conn.commit()
+
+    last, added = 0, 0
+    while True:
+        rows = conn.execute('select rowid, body, author, \
+                                    plain_body, plain_author from posts \
+                             where rowid > ? and not exists \
+                                 (select 1 from posts_fts \
+                                  where posts_fts.rowid = posts.rowid) \
+                             order by rowid limit ?', (last, every)).fetchall()
+        if not rows:
+            break
+
+        conn.executemany('insert into posts_fts (rowid, body, author) \
+                          values (?, ?, ?)',
+                         ((rowid, scrub(body), scrub(author))
+                          if plain_body is None else
+                          (rowid, plain_body, plain_author)
+                          for rowid, body, author, plain_body, plain_author
+                          in rows))
+        conn.commit()
+        last, added = rows[-1][0], added + len(rows)
+
+    if optimize:
+        conn.execute("insert into posts_fts (posts_fts) values ('optimize')")
+        conn.commit()
+    conn.close()
+
+    dt = int(time.time() - start)
+    print 'done. (%d posts, %dm%02ds)' % (added, dt / 60, dt % 60)
+
+def search_fts(db, query, sort, reverse, limit):
+    order = {'rel': 'rank', 'time': 'posts.time'}[sort]
+    if reverse:
+        order += ' desc'
+
+    conn = progdb.connect(db)
+    for thread, post, author, trip, email, timestamp, body in \
+        conn.execute('select posts.thread, posts.id, posts_fts.author, \
+                             posts.trip, posts.email, posts.time, \
+                             posts_fts.body \
+                      from posts_fts join posts \
+                          on posts.rowid = posts_fts.rowid \
+                      where posts_fts match ? \
+                      order by %s limit ?' % order, (query, limit)):
+        yield {'thread': thread, 'post': post, 'author': author,
+               'trip': trip, 'email': email, 'time': post_time(timestamp),
+               'body': body}
+    conn.close()
 
 def termwidth():
     try:
@@ -93,15 +482,27 @@ if __name__ == '__main__':
         'Build or search an index based on a /prog/scrape database. You ' +
         "need an index before you can search; if it doesn't exist, one will " +
         'be built. If one exists, it will not be updated automatically; ' +
-        'direct /prog/scrape to do so while scraping.')
+        'direct /prog/scrape to do so while scraping, or catch up later ' +
+        'with --update. The fts5 backend keeps its index in the DB, and ' +
+        'keeps it up to date by itself.')
+    parser.add_argument('-b', '--backend', choices=('whoosh', 'fts5'),
+                        default='whoosh',
+                        help='search with a Whoosh index or an SQLite FTS5 ' +
+                             'table (default whoosh)')
     parser.add_argument('-i', '--index', metavar='DIR', dest='idir',
                         help='directory in which to store the index')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='build the index with N processes ' +
+                             '(default: one per CPU)')
     parser.add_argument('-l', '--limit', metavar='N', type=int, default=10,
                         help='return at most N results (default 10)')
     parser.add_argument('-r', '--reverse', action='store_true',
                         help='reverse the result set')
     parser.add_argument('-s', '--sort', choices=('rel', 'time'), default='rel',
                         help='sort result set by relevance or time')
+    parser.add_argument('-U', '--update', action='store_true',
+                        help='add posts written to the DB since the index ' +
+                             'was last updated')
     parser.add_argument('-u', '--url', default='http://dis.4chan.org/read/prog',
                         help='board url (default http://dis.4chan.org/read/prog)')
     parser.add_argument('db', help='/prog/scrape DB file')
@@ -113,42 +514,65 @@ if __name__ == '__main__':
         print >>sys.stderr, "%s does not exist!" % args.db
         sys.exit(1)
 
-    if args.idir is None:
-        args.idir = args.db + '.index'
+    query = ' '.join(args.query).decode('utf8')
 
-    if not os.path.exists(args.idir):
-        os.mkdir(args.idir)
+    if args.backend == 'fts5':
+        conn = progdb.connect(args.db)
+        outdated = fts_outdated(conn)
+        fresh = conn.execute("select 1 from sqlite_master \
+                              where name = 'posts_fts'").fetchone() is None
+        conn.close()
 
-    indexname = os.path.basename(args.db)
+        # Build the table if it doesn't exist, or catch up.
+        if outdated or args.update:
+            build_fts(args.db, optimize=fresh)
+        elif not args.query:
+            print >>sys.stderr, 'Full-text table exists in %s.' % args.db
 
-    # Build index if it doesn't exist, or update if asked.
-    if not whoosh.index.exists_in(args.idir, indexname=indexname):
-        build_index(args.db, args.idir, indexname)
-    elif not args.query:
-        print >>sys.stderr, 'Index for %s exists in %s.' % (indexname, args.idir)
+        results = search_fts(args.db, query,
+                             args.sort, args.reverse, args.limit)
+
+    else:
+        if whoosh is None:
+            print >>sys.stderr, 'The whoosh backend needs the Whoosh module; ' \
+                                'use --backend fts5 if you don\'t have it.'
+            sys.exit(1)
+
+        if args.idir is None:
+            args.idir = args.db + '.index'
+
+        if not os.path.exists(args.idir):
+            os.mkdir(args.idir)
+
+        indexname = os.path.basename(args.db)
+
+        # Build index if it doesn't exist, or finish building it.
+        if not whoosh.index.exists_in(args.idir, indexname=indexname) or \
+           os.path.exists(parts_dir(args.idir, indexname)):
+            build_index(args.db, args.idir, indexname, args.jobs)
+        elif args.update:
+            update_index(args.db, args.idir, indexname)
+        elif not args.query:
+            print >>sys.stderr, 'Index for %s exists in %s.' % (indexname,
+                                                                args.idir)
+
+        results = search_whoosh(args.idir, indexname, query,
+                                args.sort, args.reverse, args.limit)
 
     # If we're only building the index, we're done.
     if not args.query:
         sys.exit(0)
 
-    ix = whoosh.index.open_dir(args.idir, indexname=indexname)
-    with ix.searcher() as searcher:
-        qparse = whoosh.qparser.QueryParser('body', ix.schema)
-        query = qparse.parse(' '.join(args.query).decode('utf8'))
-
-        w = termwidth() - 2
-        twrap = textwrap.TextWrapper(width=w,
-                                     initial_indent='  ',
-                                     subsequent_indent='  ')
-        qwrap = textwrap.TextWrapper(width=w,
-                                     initial_indent='  ',
-                                     subsequent_indent='  > ')
-
-        for result in searcher.search(query,
-                                      sortedby=args.sort if args.sort != 'rel' \
-                                               else None,
-                                      reverse=args.reverse,
-                                      limit=args.limit):
+    w = termwidth() - 2
+    twrap = textwrap.TextWrapper(width=w,
+                                 initial_indent='  ',
+                                 subsequent_indent='  ')
+    qwrap = textwrap.TextWrapper(width=w,
+                                 initial_indent='  ',
+                                 subsequent_indent='  > ')
+
+    try:
+        for result in results:
             author = result['author']
             if result.get('trip', None):
                 author += result['trip']
@@ -162,3 +586,7 @@ if __name__ == '__main__':
                 quote = len(line) > 1 and line[:2] == '> '
                 print (qwrap if quote else twrap).fill(line)
             print
+    except sqlite3.OperationalError, e:
+        # Most likely FTS5 query syntax
+        print >>sys.stderr, 'Bad query: %s' % e
+        sys.exit(1)
@@ -0,0 +1,44 @@
+"""
+How /prog/scrape's scripts set up their connections to a DB.
+
+progscrape.py writes with one of the profiles below. 'online' keeps the DB
+readable while a scrape is going: with a write-ahead log, readers see the
+last commit and never wait for the scraper, nor it for them. 'bulk' is for
+filling a DB as fast as possible: commits aren't synced to disk, so a power
+cut (though not a crash) can lose or corrupt the last few. Both leave the DB
+in WAL mode, which sticks to it. 'default' leaves SQLite's settings alone.
+
+Everything else connects through connect(), which reads the DB through a
+memory map.
+
+This is shared by progscrape.py and the scripts in extra/, so put it next to
+progscrape.py.
+"""
+
+import sqlite3
+
+
+# Pragmas for each profile, as [(name, value)], applied in order
+profiles = {
+    'default': [],
+    'online': [('journal_mode', 'wal'), ('synchronous', 'normal'),
+               ('cache_size', -64 * 1024)],
+    'bulk': [('journal_mode', 'wal'), ('synchronous', 'off'),
+             ('cache_size', -256 * 1024), ('temp_store', 'memory'),
+             ('wal_autocheckpoint', 10000)],
+}
+
+# How much of the DB readers map into memory, rather than reading it a page
+# at a time
+mmap_size = 256 * 1024 * 1024
+
+def set_pragmas(conn, pragmas):
+    for name, value in pragmas:
+        conn.execute('pragma %s = %s' % (name, value)).fetchall()
+
+def connect(db):
+    """Connects to db for reading, mostly."""
+
+    conn = sqlite3.connect(db)
+    set_pragmas(conn, [('mmap_size', mmap_size)])
+    return conn
@@ -1,17 +1,23 @@
 #!/usr/bin/python
 
+from __future__ import with_statement
+
+import bisect
+import calendar
 import gc
 import gzip
 import os
+import random
 import sqlite3
 import sys
 import re
+import signal
 import threading
 import time
 import Queue
+import _strptime     # time.strptime's lazy import of this isn't thread-safe
 from datetime import datetime
 from getopt import getopt
-from htmlentitydefs import name2codepoint
 from StringIO import StringIO
 
 try:
@@ -20,18 +26,34 @@ except ImportError:
     try:
         import simplejson as json
     except ImportError:
-        print "Couldn't load simplejson! Using HTML interface."
-        use_json = False
+        json = None
 
 import requests
 
+import progdb
+from progscrub import scrub
+
 try:
     import whoosh
     import whoosh.fields
     import whoosh.index
+    import whoosh.reading
 except ImportError:
     whoosh = None
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import gevent
+    import gevent.lock
+    import gevent.monkey
+    import gevent.pool
+except ImportError:
+    gevent = None
+
 
 # ``Constants''
 
@@ -43,12 +65,48 @@ charset  = 'utf-8'
 
 use_json = True
 verify_trips = True
+tripv_chunk = 200
 no_aborn = False
 
 progress_bar = True
 threads = -1
+engine = 'threads'
+host_connections = 32
+parsers = 0
+
+max_rate = 0
+fetch_timeout = 60
+retries = 3
+retry_delay = 1.0
+retry_max_delay = 30
+requeues = 3
+
+batch_size = 1000
+batch_time = 10
+chunk_size = 250
+done_queue_size = 100
+index_batch_size = 20000
+index_batch_time = 300
+
+db_profile = 'default'
+db_pragmas = []
+checkpoint_interval = 60
+db_indexes = []
+thread_stats = False
+
+stats_summary = False
+stats_file = None
+stats_format = 'json'
+stats_interval = 10
 
 dry_run = False
+resume = False
+backfill = False
+
+watch = False
+watch_min = 30
+watch_max = 600
+watch_delay = 0.1
 
 
 # Parse command line arguments
@@ -103,15 +161,105 @@ if '--help' in sys.argv or '-h' in sys.argv:
     print
     print "\t\033[1m--threads\033[0m"
     print "\t\tHow many scraper threads to use. (default: %s)" % ('auto' if threads == -1 else str(threads))
+    print "\t\tWith the async engine, how many threads to fetch at once."
+    print
+    print "\t\033[1m--engine\033[0m \033[1mthreads\033[0m|\033[1masync\033[0m"
+    print "\t\tFetch with a pool of OS threads, or with an event loop"
+    print "\t\t(requires gevent). (default: %s)" % engine
+    print
+    print "\t\033[1m--connections\033[0m \033[4mn\033[0m"
+    print "\t\tHow many connections to the server to use at once."
+    print "\t\t(default: %d)" % host_connections
+    print
+    print "\t\033[1m--rate\033[0m \033[4mrequests\033[0m"
+    print "\t\tMake at most this many requests per second on average, or 0"
+    print "\t\tfor no limit. (default: %s)" % (max_rate or 'no limit')
+    print
+    print "\t\033[1m--retries\033[0m \033[4mn\033[0m"
+    print "\t\tTry requests that fail or get a server error this many more"
+    print "\t\ttimes, waiting longer each time. Threads that still fail are"
+    print "\t\ttried again later in the run. (default: %d)" % retries
+    print
+    print "\t\033[1m--parsers\033[0m \033[4mn\033[0m"
+    print "\t\tHow many processes to parse pages in, or \033[1mauto\033[0m for one"
+    print "\t\tper CPU. With 0, pages are parsed in the scraper threads."
+    print "\t\t(default: %s)" % ('auto' if parsers == -1 else str(parsers))
+    print
+    print "\t\033[1m--batch-size\033[0m \033[4mposts\033[0m"
+    print "\t\tCommit scraped posts to the DB in transactions of at least"
+    print "\t\tthis many posts. (default: %d)" % batch_size
+    print
+    print "\t\033[1m--batch-time\033[0m \033[4mseconds\033[0m"
+    print "\t\tCommit pending posts at least this often, however few"
+    print "\t\tthere are. (default: %d)" % batch_time
+    print
+    print "\t\033[1m--chunk-size\033[0m \033[4mposts\033[0m"
+    print "\t\tFetch threads with more new posts than this in pieces of this"
+    print "\t\tsize, side by side if there are scrapers to spare, so a failure"
+    print "\t\tonly costs a piece; 0 never to. (default: %d)" % chunk_size
+    print
+    print "\t\033[1m--db-profile\033[0m \033[1mdefault\033[0m|\033[1monline\033[0m|\033[1mbulk\033[0m"
+    print "\t\tHow to set up the DB: as SQLite does by default, so that it can"
+    print "\t\tbe read while we write to it, or for loading it as fast as"
+    print "\t\tpossible. (default: %s)" % db_profile
+    print
+    print "\t\033[1m--db-pragma\033[0m \033[4mname\033[0m=\033[4mvalue\033[0m"
+    print "\t\tSet an SQLite pragma after the profile's. Can be given more"
+    print "\t\tthan once."
+    print
+    print "\t\033[1m--db-indexes\033[0m \033[4mcolumns\033[0m"
+    print "\t\tAlso index posts by these (any of \033[1mtime\033[0m, \033[1mtrip\033[0m and"
+    print "\t\t\033[1mauthor\033[0m, comma-separated, or \033[1mall\033[0m), for quick queries on them."
+    print
+    print "\t\033[1m--thread-stats\033[0m"
+    print "\t\tKeep a table of post and poster counts and first and last post"
+    print "\t\ttimes for every thread, updated as posts are written."
+    print
+    print "\t\033[1m--checkpoint-interval\033[0m \033[4mseconds\033[0m"
+    print "\t\tWith a write-ahead log, copy it back into the DB this often."
+    print "\t\t(default: %d)" % checkpoint_interval
     print
     print "\t\033[1m--dry-run\033[0m"
     print "\t\033[1m--no-dry-run\033[0m"
     print "\t\tJust figure out how many threads would have to be retrieved,"
     print "\t\tdon't actually retrieve them. (default: %s)" % ("no", "yes")[dry_run]
     print
+    print "\t\033[1m--resume\033[0m"
+    print "\t\tFinish what the last run set out to do, if it was cut short,"
+    print "\t\twithout fetching subject.txt again. With \033[1m--dry-run\033[0m, just"
+    print "\t\tsay how much is left."
+    print
+    print "\t\033[1m--watch\033[0m"
+    print "\t\tDon't exit: keep polling subject.txt and fetch threads as they"
+    print "\t\tchange, busy ones first. Stop with Ctrl-C."
+    print
+    print "\t\033[1m--watch-min\033[0m \033[4mseconds\033[0m"
+    print "\t\033[1m--watch-max\033[0m \033[4mseconds\033[0m"
+    print "\t\tWhen watching, poll subject.txt at most and at least this"
+    print "\t\toften. (default: %d and %d seconds)" % (watch_min, watch_max)
+    print
+    print "\t\033[1m--backfill\033[0m"
+    print "\t\tFill in the plaintext of posts scraped by older versions,"
+    print "\t\tthen exit."
+    print
+    print "\t\033[1m--stats\033[0m"
+    print "\t\tShow how much time each stage of scraping took at the end."
+    print
+    print "\t\033[1m--stats-file\033[0m \033[4mfile\033[0m"
+    print "\t\tKeep writing those stats to the given file as we go, every"
+    print "\t\t%d seconds." % stats_interval
+    print
+    print "\t\033[1m--stats-format\033[0m \033[1mjson\033[0m|\033[1mprometheus\033[0m"
+    print "\t\tFormat of the stats file. (default: %s)" % stats_format
+    print
     print "\t\033[1m--index\033[0m \033[4mdir\033[0m"
     print "\t\tAlso index new posts in given directory. Omit not to index."
     print
+    print "\t\033[1m--index-batch-size\033[0m \033[4mposts\033[0m"
+    print "\t\033[1m--index-batch-time\033[0m \033[4mseconds\033[0m"
+    print "\t\tCommit the index after this many new posts, or this often."
+    print "\t\t(default: %d posts, %d seconds)" % (index_batch_size, index_batch_time)
+    print
     print "\t\033[1m--help\033[0m"
     print "\t\033[1m-h\033[0m"
     print "\t\tdisplay this message and exit"
@@ -127,7 +275,20 @@ try:
                                                'partial', 'aborn', 'no-aborn',
                                                'dry-run', 'no-dry-run',
                                                'charset=', 'threads=', 'index=',
-                                               'help'])
+                                               'batch-size=', 'batch-time=',
+                                               'chunk-size=',
+                                               'db-profile=', 'db-pragma=',
+                                               'checkpoint-interval=',
+                                               'db-indexes=', 'thread-stats',
+                                               'index-batch-size=',
+                                               'index-batch-time=',
+                                               'engine=', 'connections=',
+                                               'parsers=', 'rate=', 'retries=',
+                                               'stats', 'stats-file=',
+                                               'stats-format=', 'backfill',
+                                               'resume',
+                                               'watch', 'watch-min=',
+                                               'watch-max=', 'help'])
 except:
     print "Invalid argument! Use \033[1m--help\033[0m for help."
     sys.exit(1)
@@ -185,10 +346,105 @@ for (opt, arg) in optlist:
                     threads = 1
             except ValueError:
                 print "Not a number: \033[1m%s\033[0m" % arg
+    elif opt == '--engine':
+        if arg not in ('threads', 'async'):
+            print "Unknown engine: \033[1m%s\033[0m" % arg
+            sys.exit(1)
+        elif arg == 'async' and gevent is None:
+            print "Can't use the async engine without gevent!"
+            sys.exit(1)
+        else:
+            engine = arg
+    elif opt == '--connections':
+        try:
+            host_connections = max(int(arg), 1)
+        except ValueError:
+            print "Not a number: \033[1m%s\033[0m" % arg
+    elif opt == '--rate':
+        try:
+            max_rate = max(float(arg), 0)
+        except ValueError:
+            print "Not a number: \033[1m%s\033[0m" % arg
+    elif opt == '--retries':
+        try:
+            retries = max(int(arg), 0)
+        except ValueError:
+            print "Not a number: \033[1m%s\033[0m" % arg
+    elif opt == '--parsers':
+        if arg == 'auto':
+            parsers = -1
+        else:
+            try:
+                parsers = max(int(arg), 0)
+            except ValueError:
+                print "Not a number: \033[1m%s\033[0m" % arg
+    elif opt == '--db-profile':
+        if arg not in progdb.profiles:
+            print "Unknown DB profile: \033[1m%s\033[0m" % arg
+            sys.exit(1)
+        db_profile = arg
+    elif opt == '--db-pragma':
+        m = re.match(r'^([a-z_]+)=([-\w.]+)$', arg)
+        if m is None:
+            print "Not a pragma: \033[1m%s\033[0m" % arg
+            sys.exit(1)
+        db_pragmas.append(m.groups())
+    elif opt == '--db-indexes':
+        columns = arg.split(',') if arg != 'all' else ['time', 'trip', 'author']
+        for column in columns:
+            if column not in ('time', 'trip', 'author'):
+                print "Can't index posts by \033[1m%s\033[0m" % column
+                sys.exit(1)
+            if column not in db_indexes:
+                db_indexes.append(column)
+    elif opt == '--thread-stats':
+        thread_stats = True
+    elif opt in ('--batch-size', '--batch-time', '--chunk-size',
+                 '--index-batch-size', '--index-batch-time',
+                 '--watch-min', '--watch-max', '--checkpoint-interval'):
+        try:
+            n = max(int(arg), 0)
+        except ValueError:
+            print "Not a number: \033[1m%s\033[0m" % arg
+        else:
+            if opt == '--batch-size':
+                batch_size = n
+            elif opt == '--batch-time':
+                batch_time = n
+            elif opt == '--chunk-size':
+                chunk_size = n
+            elif opt == '--index-batch-size':
+                index_batch_size = n
+            elif opt == '--index-batch-time':
+                index_batch_time = n
+            elif opt == '--watch-min':
+                watch_min = max(n, 1)
+            elif opt == '--checkpoint-interval':
+                checkpoint_interval = n
+            else:
+                watch_max = max(n, 1)
     elif opt == '--dry-run':
         dry_run = True
     elif opt == '--no-dry-run':
         dry_run = False
+    elif opt == '--resume':
+        resume = True
+    elif opt == '--backfill':
+        backfill = True
+    elif opt == '--watch':
+        watch = True
+    elif opt == '--stats':
+        stats_summary = True
+    elif opt == '--stats-file':
+        stats_file = arg
+    elif opt == '--stats-format':
+        if arg not in ('json', 'prometheus'):
+            print "Unknown stats format: \033[1m%s\033[0m" % arg
+            sys.exit(1)
+        if arg == 'json' and json is None:
+            print "Can't write stats as JSON without simplejson!"
+            sys.exit(1)
+        stats_format = arg
     elif opt == '--index':
         if whoosh is None:
             print "Can't index posts without Whoosh!"
@@ -196,6 +452,21 @@ for (opt, arg) in optlist:
         else:
             idir = arg
 
+if json is None and use_json:
+    print "Couldn't load simplejson! Using HTML interface."
+    use_json = False
+
+if watch and (partial or dry_run or resume):
+    print "Can't watch the board with \033[1m--partial\033[0m, " \
+          "\033[1m--dry-run\033[0m or \033[1m--resume\033[0m."
+    sys.exit(1)
+
+if resume and partial:
+    print "Can't resume with \033[1m--partial\033[0m."
+    sys.exit(1)
+
+watch_max = max(watch_max, watch_min)
+
 if len(board) > 0:
     if board[-1] != '/':
         board += '/'
@@ -221,6 +492,7 @@ db_conn = sqlite3.connect(db_name)
 db = db_conn.cursor()
 
 try:
+    progdb.set_pragmas(db_conn, progdb.profiles[db_profile] + db_pragmas)
     db.execute("""
         CREATE TABLE IF NOT EXISTS threads (
             thread INTEGER PRIMARY KEY,
@@ -236,9 +508,51 @@ try:
             trip TEXT,
             time INTEGER,
             body TEXT,
+            plain_body TEXT,
+            plain_author TEXT,
+            PRIMARY KEY (thread, id)
+        )""")
+    columns = [c[1] for c in db.execute('pragma table_info(posts)')]
+    for column in ('plain_body', 'plain_author'):
+        if column not in columns:
+            db.execute('alter table posts add column %s TEXT' % column)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS unindexed (
+            thread INTEGER,
+            id INTEGER,
             PRIMARY KEY (thread, id)
         )""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS index_state (
+            indexname TEXT PRIMARY KEY,
+            generation INTEGER,
+            last_change INTEGER
+        )""")
+    columns = [c[1] for c in db.execute('pragma table_info(index_state)')]
+    if 'last_change' not in columns:
+        db.execute('alter table index_state add column last_change INTEGER')
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS log_posts AFTER INSERT ON posts
+        WHEN EXISTS (SELECT 1 FROM index_state)
+        BEGIN
+            INSERT OR REPLACE INTO unindexed VALUES (new.thread, new.id);
+        END""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS validators (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT
+        )""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            thread INTEGER PRIMARY KEY,
+            last_post INTEGER,
+            replies INTEGER,
+            state TEXT
+        )""")
     db_conn.commit()
+
+    db_wal = db.execute('pragma journal_mode').fetchone()[0] == 'wal'
     
 except sqlite3.DatabaseError:
     # Specified DB file exists, but isn't an SQLite DB file.
@@ -246,6 +560,259 @@ except sqlite3.DatabaseError:
     raise
 
 
+# Instrumentation. Each stage of a scrape records how long it takes; these
+# are kept in stage_times as {stage: [calls, seconds, max, bucket counts...]},
+# where bucket i counts the calls that took at most stats_buckets[i] (the last
+# one counts the rest). Counters go in stage_counts, and samples of queue
+# sizes in queue_sizes as {queue: [samples, total, max, last]}.
+
+stats_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                 1.0, 2.5, 5.0, 10.0)
+stage_times, stage_counts, queue_sizes = {}, {}, {}
+stats_lock = threading.Lock()
+
+def record(stage, seconds):
+    with stats_lock:
+        t = stage_times.get(stage)
+        if t is None:
+            t = stage_times[stage] = [0, 0.0, 0.0] + [0] * (len(stats_buckets) + 1)
+
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+        t[3 + bisect.bisect_left(stats_buckets, seconds)] += 1
+
+class timed(object):
+    """Records how long a with block takes as the given stage."""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        record(self.stage, time.time() - self.start)
+
+def count(counter, n=1):
+    with stats_lock:
+        stage_counts[counter] = stage_counts.get(counter, 0) + n
+
+def merge_stats(times, counts):
+    """Adds stats gathered elsewhere (like in a parse process) to ours."""
+
+    with stats_lock:
+        for stage in times:
+            if stage not in stage_times:
+                stage_times[stage] = times[stage]
+            else:
+                t = stage_times[stage]
+                stage_times[stage] = [t[0] + times[stage][0],
+                                      t[1] + times[stage][1],
+                                      max(t[2], times[stage][2])] + \
+                                     map(sum, zip(t[3:], times[stage][3:]))
+
+        for counter in counts:
+            stage_counts[counter] = stage_counts.get(counter, 0) + counts[counter]
+
+def sample_queues():
+    for name, q in (('todo_queue', todo_queue), ('done_queue', done_queue)):
+        size = q.qsize()
+        s = queue_sizes.setdefault(name, [0, 0, 0, 0])
+        s[0] += 1
+        s[1] += size
+        s[2] = max(s[2], size)
+        s[3] = size
+
+def stats_json():
+    stages = {}
+    for stage, t in stage_times.items():
+        stages[stage] = {'count': t[0], 'sum': t[1], 'max': t[2],
+                         'buckets': dict(zip(map(str, stats_buckets) + ['+Inf'],
+                                             t[3:]))}
+
+    queues = {}
+    for name, s in queue_sizes.items():
+        queues[name] = {'samples': s[0], 'mean': s[1] * 1.0 / max(s[0], 1),
+                        'max': s[2], 'last': s[3]}
+
+    return json.dumps({'time': time.time(), 'errors': errors, 'stages': stages,
+                       'counters': stage_counts, 'queues': queues},
+                      indent=2, sort_keys=True)
+
+def stats_prometheus():
+    out = ['# TYPE progscrape_stage_seconds histogram']
+    for stage, t in sorted(stage_times.items()):
+        label = stage.replace(' ', '_')
+        cumulative = 0
+        for le, n in zip(map(str, stats_buckets) + ['+Inf'], t[3:]):
+            cumulative += n
+            out.append('progscrape_stage_seconds_bucket{stage="%s",le="%s"} %d' %
+                       (label, le, cumulative))
+        out.append('progscrape_stage_seconds_sum{stage="%s"} %f' % (label, t[1]))
+        out.append('progscrape_stage_seconds_count{stage="%s"} %d' % (label, t[0]))
+
+    out.append('# TYPE progscrape_total counter')
+    for counter, n in sorted(stage_counts.items()):
+        out.append('progscrape_total{counter="%s"} %d' %
+                   (counter.replace(' ', '_'), n))
+    out.append('progscrape_total{counter="errors"} %d' % errors)
+
+    out.append('# TYPE progscrape_queue_size gauge')
+    for name, s in sorted(queue_sizes.items()):
+        out.append('progscrape_queue_size{queue="%s"} %d' % (name, s[3]))
+
+    out.append('# TYPE progscrape_queue_size_max gauge')
+    for name, s in sorted(queue_sizes.items()):
+        out.append('progscrape_queue_size_max{queue="%s"} %d' % (name, s[2]))
+
+    return '\n'.join(out) + '\n'
+
+def write_stats_file():
+    # Write to a temporary file first, so readers never see half of it
+    f = open(stats_file + '.tmp', 'w')
+    f.write(stats_json() if stats_format == 'json' else stats_prometheus())
+    f.close()
+    os.rename(stats_file + '.tmp', stats_file)
+
+def show_stats():
+    print
+    print "%-16s %8s %10s %10s %10s" % ('stage', 'calls', 'total (s)',
+                                         'mean (ms)', 'max (ms)')
+    for stage, t in sorted(stage_times.items()):
+        print "%-16s %8d %10.2f %10.2f %10.2f" % (stage, t[0], t[1],
+                                                  t[1] * 1000 / t[0],
+                                                  t[2] * 1000)
+
+    if stage_counts:
+        print
+        for counter, n in sorted(stage_counts.items()):
+            print "%-16s %8d" % (counter, n)
+
+    if queue_sizes:
+        print
+        print "%-16s %8s %10s %10s" % ('queue', 'samples', 'mean', 'max')
+        for name, s in sorted(queue_sizes.items()):
+            print "%-16s %8d %10.1f %10d" % (name, s[0],
+                                              s[1] * 1.0 / max(s[0], 1), s[2])
+    print
+
+
+# HTML cruft is scrubbed from post bodies and usernames once, when they're
+# parsed, and the plaintext is kept in the DB for the index, the full-text table
+# and the reader (see progscrub.py)
+
+def add_plaintext(posts):
+    """Appends the plaintext body and author to each post."""
+
+    with timed('scrub'):
+        for post in posts:
+            post.extend((scrub(post[6]), scrub(post[2])))
+    return posts
+
+def scrub_rows(rows):
+    return [(scrub(body), scrub(author), rowid) for rowid, author, body in rows]
+
+def ignore_sigint():
+    """Ctrl-C goes to the whole process group, but it's for us to deal with,
+    not for our worker processes: they have work to finish."""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Fill in plaintext for posts from before we kept it, if asked
+
+if backfill:
+    print "Filling in plaintext for old posts...",
+    sys.stdout.flush()
+
+    scrub_map = map
+    if parsers != 0 and multiprocessing is not None:
+        scrub_map = multiprocessing.Pool(parsers if parsers > 0 else None,
+                                         ignore_sigint).map
+
+    start, last, filled = time.time(), 0, 0
+    while True:
+        rows = db.execute('select rowid, author, body from posts \
+                           where rowid > ? and plain_body is null \
+                           order by rowid limit ?',
+                          (last, batch_size * 10)).fetchall()
+        if len(rows) == 0:
+            break
+
+        for chunk in scrub_map(scrub_rows, [rows[i:i + batch_size] for i in
+                                            xrange(0, len(rows), batch_size)]):
+            db.executemany('update posts set plain_body = ?, plain_author = ? \
+                            where rowid = ?', chunk)
+        db_conn.commit()
+        last, filled = rows[-1][0], filled + len(rows)
+
+    print "done. (%d posts in %.2fs)" % (filled, time.time() - start)
+    sys.exit(0)
+
+
+# Secondary indexes on posts and per-thread stats, for whoever reads the DB,
+# if asked. Once they're there, they're kept up to date whether they're asked
+# for again or not: SQLite sees to the indexes, and commit_batch to the stats.
+# With the bulk profile they're made at the end, which is quicker than
+# keeping them up to date all along.
+
+post_indexes = {'time': 'time', 'trip': 'trip', 'author': 'plain_author'}
+
+def has_thread_stats():
+    return db.execute("select 1 from sqlite_master \
+                       where type = 'table' and name = 'thread_stats'") \
+             .fetchone() is not None
+
+def add_extras():
+    global stats_table
+
+    with timed('db extras'):
+        for column in db_indexes:
+            db.execute('create index if not exists posts_%s on posts (%s)' %
+                       (column, post_indexes[column]))
+
+        if thread_stats and not has_thread_stats():
+            # Posters are told apart by name and tripcode. last_id is the
+            # highest post that's been counted.
+            db.execute("""
+                CREATE TABLE thread_posters (
+                    thread INTEGER,
+                    author TEXT,
+                    trip TEXT,
+                    PRIMARY KEY (thread, author, trip)
+                )""")
+            db.execute("""
+                CREATE TABLE thread_stats (
+                    thread INTEGER PRIMARY KEY,
+                    posts INTEGER,
+                    posters INTEGER,
+                    first_time INTEGER,
+                    last_time INTEGER,
+                    last_id INTEGER
+                )""")
+            db.execute("""
+                INSERT INTO thread_posters
+                SELECT DISTINCT thread, coalesce(author, ''), coalesce(trip, '')
+                FROM posts""")
+            db.execute("""
+                INSERT INTO thread_stats
+                SELECT thread, count(*),
+                       (SELECT count(*) FROM thread_posters
+                        WHERE thread_posters.thread = posts.thread),
+                       min(time), max(time), max(id)
+                FROM posts GROUP BY thread""")
+
+        db_conn.commit()
+
+    stats_table = has_thread_stats()
+
+stats_table = has_thread_stats()
+
+if db_profile != 'bulk':
+    add_extras()
+
+
 # Open the index if we're doing that
 
 if idir is not None:
@@ -267,45 +834,263 @@ if idir is not None:
     else:
         ix = whoosh.index.open_dir(idir, indexname=indexname)
 
-    # Need to scrub HTML cruft from post bodies and usernames
-    def scrub(s, regices=[re.compile('<.*?>'),
-                          re.compile(r'&#(\d+);'),
-                          re.compile('&(%s);' % '|'.join(name2codepoint))]):
-        if s is None:
-            return u''
-        s = s.replace('<br/>', '\n')
-        s = s.replace("<span class='quote'>", '> ')
-        s = regices[0].sub('', s)
-        s = regices[1].sub(lambda m: unichr(int(m.group(1))) \
-                                     if int(m.group(1)) <= 0x10ffff \
-                                     else m.group(0), s)
-        s = regices[2].sub(lambda m: unichr(name2codepoint[m.group(1)]), s)
-        return s
+    def index_posts(posts):
+        global ixwriter, ix_posts
 
+        for post in posts:
+            if ixwriter is None:
+                ixwriter = ix.writer()
 
-# Try to fetch subject.txt
+            try:
+                timestamp = float(post[5])
+            except:
+                timestamp = 0.0
+            if post[7] is None:
+                # Not backfilled yet
+                post = tuple(post[:7]) + (scrub(post[6]), scrub(post[2]))
+
+            ixwriter.add_document(thread=int(post[0]), post=int(post[1]),
+                                  author=post[8], email=post[3],
+                                  trip=post[4],
+                                  time=datetime.fromtimestamp(timestamp),
+                                  body=post[7])
+            ix_posts += 1
+
+    def merge_new_segments(writer, segments):
+        """Merge policy that merges all of the segments this run made."""
+
+        for seg in segments:
+            if seg.segment_id() not in ix_segments:
+                reader = whoosh.reading.SegmentReader(writer.storage,
+                                                      writer.schema, seg)
+                writer.add_reader(reader)
+                reader.close()
+
+        return [seg for seg in segments if seg.segment_id() in ix_segments]
+
+    def forget_unindexed(last_change):
+        """Deletes the rows of unindexed up to last_change. Their rowids can
+        be reused after that, so last_change has to go too."""
+
+        db.execute('delete from unindexed where rowid <= ?', (last_change,))
+        db.execute('update index_state set last_change = 0 \
+                    where indexname = ?', (indexname,))
+
+    def commit_index(merge=False):
+        """Commits the index, and forgets about unindexed posts in the same
+        breath. Segments are only merged if asked."""
+
+        global ixwriter, ix_posts, ix_start
+
+        if merge and ixwriter is None and \
+           len([seg for seg in ix._segments()
+                    if seg.segment_id() not in ix_segments]) > 1:
+            ixwriter = ix.writer()
+
+        if ixwriter is not None:
+            with timed('index commit'):
+                last_change = db.execute('select max(rowid) from unindexed') \
+                                .fetchone()[0] or 0
+                db.execute('update index_state set generation = ?, \
+                            last_change = ? where indexname = ?',
+                           (ix.latest_generation() + 1, last_change, indexname))
+                db_conn.commit()
+                if merge:
+                    ixwriter.commit(mergetype=merge_new_segments)
+                else:
+                    ixwriter.commit(merge=False)
+                forget_unindexed(last_change)
+                db_conn.commit()
+
+        ixwriter, ix_posts, ix_start = None, 0, time.time()
+
+    # One writer is kept open across many batches of posts, and committed
+    # every index_batch_size posts or index_batch_time seconds; the segments
+    # this makes are only merged at the end of the run.
+    #
+    # Once a DB has an index, the log_posts trigger lists every post written
+    # to it in the unindexed table, whether or not that run was indexing.
+    # Before committing the index, index_state gets the generation the commit
+    # will make and the last row of unindexed it covers, and that much of
+    # unindexed is deleted afterwards. If the index got to that generation,
+    # it's safe to delete those rows now; whatever's left is added again.
+    # (Once they're deleted, last_change goes back to 0: rowids get reused.)
+    ixwriter, ix_posts, ix_start = None, 0, time.time()
+    ix_segments = set(seg.segment_id() for seg in ix._segments())
+
+    state = db.execute('select generation, last_change from index_state \
+                        where indexname = ?', (indexname,)).fetchone()
+
+    if state is None:
+        db.execute('delete from unindexed')
+        db.execute('insert into index_state values (?, ?, 0)',
+                   (indexname, ix.latest_generation()))
+    elif ix.latest_generation() >= state[0]:
+        forget_unindexed(state[1])
+    db_conn.commit()
+
+    index_posts(db.execute('select thread, id, author, email, trip, time, body, \
+                                   plain_body, plain_author \
+                            from unindexed natural join posts'))
+    commit_index()
+
+
+# Fetching pages
 
 gc.set_threshold(20, 4, 2)
-session = requests.session()
 
-print "Fetching subject.txt...",
-sys.stdout.flush()
+def new_session():
+    s = requests.session()
+    s.mount('http://',
+            requests.adapters.HTTPAdapter(pool_maxsize=host_connections))
+    return s
 
-def urlopen(url):
-    return session.get("http://" + base_url + url, headers = {'User-Agent' : 'progscrape/1.4'}).content
+session = new_session()
 
-try:
-    subjecttxt = urlopen(prog_url + 'subject.txt')
-except:
-    print "Can't find it! Exiting."
-    raise
+# Pages that are decoded as they come in are read this much at a time
+read_size = 16 * 1024
+
+# At most host_connections requests are made at once. The async engine swaps
+# this for a semaphore greenlets can wait on, and time.sleep for gevent's.
+connection_slots = threading.BoundedSemaphore(host_connections)
+sleep = time.sleep
+
+class RateLimit(object):
+    """Token bucket that lets through rate requests per second on average,
+    and up to a second's worth at once after a lull. Whoever takes a token
+    that isn't there yet waits until it is."""
+
+    def __init__(self, rate):
+        self.rate, self.burst = rate, max(rate, 1)
+        self.tokens, self.last = self.burst, time.time()
+        self.lock = threading.Lock()
 
-print "Got it."
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.last) * self.rate,
+                              self.burst) - 1
+            self.last = now
+            delay = -self.tokens / self.rate
 
+        if delay > 0:
+            with timed('rate limit'):
+                sleep(delay)
 
-# Parse each line, check with DB, keep a list of all threads to be updated
+rate_limit = RateLimit(max_rate) if max_rate > 0 else None
 
-regex = re.compile(u"""
+def backoff(attempt):
+    """How long to wait before trying again after attempt failed ones:
+    exponential, with full jitter so that retries don't come in waves."""
+
+    return random.uniform(0, min(retry_delay * 2 ** attempt, retry_max_delay))
+
+def content_chunks(r):
+    for chunk in r.iter_content(read_size):
+        count('bytes fetched', len(chunk))
+        yield chunk
+
+def urlopen(url, headers={}, stage='fetch', read=None):
+    """Fetches url. If read is given, the page isn't read in one go: read is
+    called with an iterator over its content in chunks, while we still have
+    the connection, and what it returns is kept in the response's result."""
+
+    h = {'User-Agent': 'progscrape/1.4', 'Accept-Encoding': 'gzip'}
+    h.update(headers)
+
+    # Connection errors, timeouts and server errors are retried a few times;
+    # if the server says how long to back off for, we listen.
+    for attempt in xrange(retries + 1):
+        if rate_limit is not None:
+            rate_limit.wait()
+
+        try:
+            with connection_slots:
+                with timed(stage):
+                    r = session.get("http://" + base_url + url, headers=h,
+                                    timeout=fetch_timeout,
+                                    stream=read is not None)
+
+                done = r.status_code < 500 and r.status_code != 429
+                if done and read is not None and r.status_code != 304:
+                    try:
+                        r.result = read(content_chunks(r))
+                    except:
+                        r.close()
+                        raise
+                else:
+                    count('bytes fetched', len(r.content))
+        except requests.RequestException:
+            if attempt == retries or stopping.isSet():
+                raise
+            delay = backoff(attempt)
+        else:
+            if done:
+                break
+            if attempt == retries or stopping.isSet():
+                r.raise_for_status()
+            delay = backoff(attempt)
+            if r.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, min(int(r.headers['Retry-After']),
+                                       retry_max_delay))
+
+        count('retries')
+        sleep(delay)
+
+    return r
+
+# Validators (ETag and Last-Modified) from earlier runs, so we can ask for
+# pages only if they changed. Fresh ones are kept in fetched_validators until
+# whatever they validate is safely in the DB. There's one URL per directory
+# (a thread's pages, or the board), as {directory: url} in validator_dirs.
+validators = dict((row[0], row[1:]) for row in
+                  db.execute('select url, etag, last_modified from validators'))
+validator_dirs = dict((url[:url.rindex('/') + 1], url) for url in validators)
+fetched_validators = {}
+
+def urlopen_if_modified(url, read=None):
+    """Returns the page at url (or what read makes of it, as for urlopen), or
+    None if it hasn't changed since last time. Any new validators are put in
+    fetched_validators[url]."""
+
+    etag, modified = validators.get(url, (None, None))
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    r = urlopen(url, headers, read=read)
+    if r.status_code == 304:
+        count('not modified')
+        return None
+
+    etag, modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+    if etag or modified:
+        fetched_validators[url] = (etag, modified)
+
+    return r.content if read is None else r.result
+
+def save_validators(urls):
+    rows = [(url,) + fetched_validators.pop(url) for url in urls
+                                                 if url in fetched_validators]
+    dirs = [row[0][:row[0].rindex('/') + 1] for row in rows]
+
+    # Thread page URLs change as threads grow, so forget the old ones
+    db.executemany(u'delete from validators where substr(url, 1, ?) = ?',
+                   [(len(d), d) for d in dirs])
+    db.executemany(u'insert or replace into validators values (?, ?, ?)', rows)
+
+    for d, row in zip(dirs, rows):
+        validators.pop(validator_dirs.get(d), None)
+        validators[row[0]] = row[1:]
+        validator_dirs[d] = row[0]
+
+
+# Parse each line of subject.txt, check with DB, and list the threads that
+# need updating
+
+subject_regex = re.compile(u"""
     ^(?P<subject>.*)    # Subject
     <>
     .*?                 # Creator's name
@@ -321,64 +1106,93 @@ regex = re.compile(u"""
     (?P<last_post>\d*)  # Time of last post
     \\n$""", re.VERBOSE)
 
-to_update, tot_posts = [], 0
-partial_threads = "".join(sys.stdin.readlines()).split() if partial else None
-todo_queue, done_queue = Queue.Queue(), Queue.Queue()
+def plan(subjecttxt, only=None):
+    """Returns the threads that need updating, as a list of ((id, last_post,
+    first post to fetch), approx. posts, seconds it had been quiet for before
+    its last post). New threads are added to the DB. If only is given, the
+    threads that aren't in it are left alone."""
 
-for line in subjecttxt.splitlines(True):
-    line = unicode(line, "latin-1")
+    to_update = []
 
-    try:
-        thread = regex.match(line).groupdict()
-        thread = dict((a, thread[a].encode('latin-1').decode(charset, 'replace'))
-                      for a in thread)
+    # What we already have, as {thread: (last_post, highest post ID)}
+    known = dict((row[0], row[1:]) for row in db.execute("""
+        select thread, last_post,
+               (select max(id) from posts where posts.thread = threads.thread)
+        from threads"""))
+    new_threads = []
 
-        if partial and thread['id'] not in partial_threads:
-            continue
+    for line in subjecttxt.splitlines(True):
+        line = unicode(line, "latin-1")
 
-        last_post = db.execute('select last_post from threads where thread = ?',
-                               (thread['id'],)).fetchone()
+        try:
+            thread = subject_regex.match(line).groupdict()
+            thread = dict((a, thread[a].encode('latin-1').decode(charset,
+                                                                  'replace'))
+                          for a in thread)
 
-        if last_post is None:
-            # Wholly new thread
-            db.execute('insert into threads values (?, ?, ?)',
-                       (thread['id'], thread['subject'], 0))
-            last_post = 0
+            if only is not None and thread['id'] not in only:
+                continue
 
-        elif int(last_post[0]) < int(thread['last_post']):
-            # We already have part of this thread
-            last_post = db.execute('select max(id) from posts where thread = ?',
-                                   (thread['id'],)).fetchone()
-            last_post = last_post[0] or 0
+            tid = int(thread['id'])
 
-        else:
-            # Thread is up to date
-            continue
+            if tid not in known:
+                # Wholly new thread
+                new_threads.append((tid, thread['subject'], 0))
+                known[tid] = (0, 0)
+                last_post = 0
 
-        to_update.append(thread['id'])
-        todo_queue.put((thread['id'], thread['last_post'], last_post + 1))
-        tot_posts += int(thread['replies']) - last_post
+            elif int(known[tid][0]) < int(thread['last_post']):
+                # We already have part of this thread
+                last_post = known[tid][1] or 0
 
-    except:
-        # Failed to parse line; skip it
-        print "! subject.txt fail:", line.rstrip()
+            else:
+                # Thread is up to date
+                continue
 
-if partial and len(to_update) != len(partial_threads):
-    print "Some of the threads you listed either don't need updating or",\
-          "don't exist:"
-        
-    for thread in partial_threads:
-        if thread not in to_update:
-            print " ", thread
+            quiet = int(thread['last_post']) - \
+                    (int(known[tid][0]) or int(thread['last_post']))
+            to_update.append(((thread['id'], thread['last_post'],
+                               last_post + 1),
+                              int(thread['replies']) - last_post, quiet))
 
-tot = len(to_update)
+        except:
+            # Failed to parse line; skip it
+            print "! subject.txt fail:", line.rstrip()
 
-print "%d thread%s to update (approx. %d post%s)." % \
-      (tot, '' if tot == 1 else 's', tot_posts, '' if tot_posts == 1 else 's')
+    db.executemany('insert into threads values (?, ?, ?)', new_threads)
+    return to_update
 
-if dry_run:
-    print "Dry run; exiting."
-    sys.exit(0)
+
+# The journal. A full run writes down the threads it's going to update (as
+# 'planned') before it starts, and each one is marked 'committed' in the same
+# transaction as its posts, so if the run is cut short, --resume can carry on
+# without fetching and going through subject.txt again.
+
+def write_journal(to_update):
+    db.execute('delete from journal')
+    db.executemany(u"insert into journal values (?, ?, ?, 'planned')",
+                   ((thread[0], thread[1], thread[2] - 1 + posts)
+                    for thread, posts, quiet in to_update))
+    db_conn.commit()
+
+def read_journal():
+    """Returns what's left to do from the journal, like plan() does, and
+    how many threads were planned in all. Threads that have been updated
+    some other way since are left out."""
+
+    planned = db.execute('select count(*) from journal').fetchone()[0]
+    to_update = []
+
+    for tid, last_post, replies, have in db.execute("""
+        select journal.thread, journal.last_post, journal.replies,
+               (select max(id) from posts where posts.thread = journal.thread)
+        from journal join threads on threads.thread = journal.thread
+        where state != 'committed' and threads.last_post < journal.last_post
+        order by journal.rowid"""):
+        to_update.append(((unicode(tid), unicode(last_post), (have or 0) + 1),
+                          replies - (have or 0), 0))
+
+    return to_update, planned
 
 
 # Fetch new posts
@@ -394,228 +1208,523 @@ def error(message):
     if progress_bar:
         print
 
+json_checked = False
+
+def check_json(thread):
+    """Falls back to the HTML interface if the JSON one doesn't work."""
+
+    global use_json, json_checked
 
-if tot > 0 and use_json:
+    json_checked = True
     try:
-        json_test = urlopen(json_url + to_update[0][0])
+        urlopen(json_url + thread + '/1')
     except:
         print "Can't access JSON interface! Using HTML interface."
         use_json = False
 
 
-def scrape_json():
-    global todo_queue, done_queue
+# Scrapers. Each takes a thread from todo_queue, as (id, last_post, first post,
+# last post or None for all the rest), and returns what goes on
+# done_queue, or None if it failed for good. If it failed in a way that might
+# go away if we try again later, they raise ScrapeError instead. The CPU-heavy
+# parts are run through parse(function, args), so engines can decide where
+# parsing happens.
+#
+# The whole run's threads go on todo_queue at the start, but done_queue only
+# holds so many pages: if the DB can't keep up, the scrapers wait for it.
 
-    # Tripcode and email, but no name
-    name1 = u'^!<a href="mailto:(?P<meiru>[^"]*)">(?P<trip>![a-zA-Z0-9./]{10}|!(?:[a-zA-Z0-9./]{10})?![a-zA-Z0-9+/]{15})</a>$'
-    name1 = re.compile(name1, re.DOTALL)
+class ScrapeError(Exception):
+    pass
 
-    # Email and name, optional tripcode
-    name2 = u'^<a href="mailto:(?P<meiru>[^"]*)">(?P<name>.*?)</a>(?P<trip>![a-zA-Z0-9./]{10}|!(?:[a-zA-Z0-9./]{10})?![a-zA-Z0-9+/]{15})?$'
-    name2 = re.compile(name2, re.DOTALL)
+todo_queue, done_queue = Queue.Queue(), Queue.Queue(done_queue_size)
 
-    # Ambiguous tripcode
-    maybe_trip = u'^.*?!(?:[a-zA-Z0-9./]{10}|(?:[a-zA-Z0-9./]{10})?![a-zA-Z0-9+/]{15})$'
-    maybe_trip = re.compile(maybe_trip, re.DOTALL)
+# Set on Ctrl-C: scrapers stop taking on threads, and whatever was already
+# scraped is written before we exit
+stopping = threading.Event()
 
-    htripregex = u'<h3><span class="postnum"><a href=\'javascript:quote\(%s,"post1"\);\'>%s</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span> ?<span class="postertrip">(?P<trip>.*?)</span>'
-
-    while not todo_queue.empty():
-        try:
-            thread, posts = todo_queue.get(timeout=2), []
-        except:
-            continue
+# Tripcode and email, but no name
+name1 = u'^!<a href="mailto:(?P<meiru>[^"]*)">(?P<trip>![a-zA-Z0-9./]{10}|!(?:[a-zA-Z0-9./]{10})?![a-zA-Z0-9+/]{15})</a>$'
+name1 = re.compile(name1, re.DOTALL)
 
-        try:
-            page = urlopen(json_url + thread[0] + '/%d-' % thread[2])
-        except:
-            error("Can't access %s, thread skipped." % (json_url + thread[0]))
-            continue
+# Email and name, optional tripcode
+name2 = u'^<a href="mailto:(?P<meiru>[^"]*)">(?P<name>.*?)</a>(?P<trip>![a-zA-Z0-9./]{10}|!(?:[a-zA-Z0-9./]{10})?![a-zA-Z0-9+/]{15})?$'
+name2 = re.compile(name2, re.DOTALL)
 
-        try:
-            page = json.loads(page)
-        except ValueError:
-            error("Can't parse JSON, thread %s skipped." % thread[0])
-            continue
+# Ambiguous tripcode
+maybe_trip = u'^.*?!(?:[a-zA-Z0-9./]{10}|(?:[a-zA-Z0-9./]{10})?![a-zA-Z0-9+/]{15})$'
+maybe_trip = re.compile(maybe_trip, re.DOTALL)
 
+# Post header, for verifying tripcodes
+htripregex = u'<h3><span class="postnum"><a href=\'javascript:quote\((?P<id>\d+),"post1"\);\'>(?P=id)</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span> ?<span class="postertrip">(?P<trip>.*?)</span>'
+htripregex = re.compile(htripregex, re.DOTALL)
 
-        # Parse names, because the JSON interface sucks
+postregex = u"""\
+<h3><span class="postnum"><a href='javascript:quote\((?P<id>\d+),"post1"\);'>(?P=id)</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span><span class="postertrip">(?P<trip>.*?)</span> : <span class="posterdate">(?P<time>.*?)</span> <span class="id">.*?</span></span></h3>
+<blockquote>
+\t(?:<div class="aa">)?<p>
+(?P<body>.*?)
+\t</p>(?:</div>)?
+"""
+postregex = re.compile(postregex, re.DOTALL)
 
-        tripv, hp = [], None
+# Just the post number, to skip posts we already have without parsing them
+postnumregex = r"""<span class="postnum"><a href='javascript:quote\((\d+),"""
+postnumregex = re.compile(postnumregex)
 
-        for post in page:
-            p = page[post]
+meiruregex = u'<a href="mailto:(?P<meiru>.*?)">(?P<rest>[^<]*)</a>'
+meiruregex = re.compile(meiruregex)
 
-            if p['name'] is None: p['name'] = u''
 
-            m = name1.match(p['name'])
+if json is not None:
+    json_decoder = json.JSONDecoder()
+json_space = re.compile(r'[ \t\n\r]*')
 
-            if m is not None:
-                # Tripcode and email, but no name
+def json_stream(chunks):
+    """Decodes a JSON thread page that comes in chunks, yielding its posts as
+    (post number, post) as soon as each one is all there, so only a post or
+    so of the page needs to be in memory at once. A page without posts may
+    come as [], which is what PHP makes of an empty array."""
 
-                for n in ('meiru', 'trip'):
-                    p[n] = m.group(n)
+    chunks, buf, pos, expect = iter(chunks), '', 0, '{['
 
-                p['name'] = u''
+    while expect:
+        i = json_space.match(buf, pos).end()
+        c, post = buf[i:i + 1], None
 
+        try:
+            if c == '' or c not in expect:
+                raise ValueError("Expecting one of %r" % expect)
+
+            if c == '"':
+                post, i = json_decoder.raw_decode(buf, i)
+                i = json_space.match(buf, i).end()
+                if buf[i:i + 1] != ':':
+                    raise ValueError("Expecting ':'")
+                p, i = json_decoder.raw_decode(buf,
+                                               json_space.match(buf, i + 1).end())
+                expect = ',}'
+
+                # Usually the comma after a post is here too
+                if buf[i:i + 1] == ',':
+                    i, expect = i + 1, '"'
             else:
-                m = name2.match(p['name'])
+                i += 1
+                expect = {'{': '"}', ',': '"', '}': '',
+                          '[': ']', ']': ''}[c]
 
-                if m is not None:
-                    # Email and name, optional tripcode
-
-                    for n in ('meiru', 'trip', 'name'):
-                        p[n] = m.group(n)
-
-                else:
-                    # Anything without e-mail
+        except ValueError, e:
+            # Unless that was the whole page, the rest may just not be here yet
+            try:
+                chunk = chunks.next()
+            except StopIteration:
+                raise e
+            buf, pos = buf[pos:] + chunk, 0
+            continue
 
-                    for n in ('meiru', 'trip'):
-                        p[n] = u''
+        pos = i
+        if post is not None:
+            yield post, p
+
+    if (buf[pos:] + ''.join(chunks)).strip(' \t\n\r'):
+        raise ValueError("Extra data after the posts")
+
+def split_name(p):
+    """Splits up the name of the JSON post p, because the JSON interface
+    sucks. Returns whether its tripcode is ambiguous."""
+
+    if p['name'] is None: p['name'] = u''
+
+    m = name1.match(p['name'])
+    if m is not None:
+        # Tripcode and email, but no name
+        p['meiru'], p['trip'] = m.group('meiru', 'trip')
+        p['name'] = u''
+        return False
+
+    m = name2.match(p['name'])
+    if m is not None:
+        # Email and name, optional tripcode
+        p['meiru'], p['trip'], p['name'] = m.group('meiru', 'trip', 'name')
+        return False
+
+    # Anything without e-mail
+    p['meiru'] = p['trip'] = u''
+    return maybe_trip.match(p['name']) is not None
+
+def json_row(thread, post, p):
+    """The JSON post p, ready to be inserted, or None if it's to be left out."""
+
+    if no_aborn and p['name'] == u'SILENT!ABORN' and \
+                    p['com'] == u'SILENT' and \
+                    p['now'] == u'1234':
+        return None
+
+    return [unicode(s, charset, "replace") if type(s) == str else s
+            for s in (thread[0], post, p['name'], p['meiru'], p['trip'],
+                      p['now'], p['com'])]
+
+def parse_json(thread, chunks):
+    """Decodes a JSON thread page, in chunks as it comes in, and splits up
+    its names on the way. Returns the posts ready to be inserted, and the
+    ones with ambiguous tripcodes that still need verifying, as {post
+    number: post}; only those are kept around as they are."""
+
+    posts, tripv = [], {}
+
+    # When the page is streamed, this includes waiting for the rest of it
+    with timed('json decode'):
+        for post, p in json_stream(chunks):
+            if split_name(p) and verify_trips:
+                tripv[post] = p
+                continue
 
-                    if maybe_trip.match(p['name']):
-                        # Ambiguous tripcode
+            row = json_row(thread, post, p)
+            if row is not None:
+                posts.append(row)
 
-                        tripv.append(post)
+    return add_plaintext(posts), tripv
 
+def verify_json_trips(thread, tripv, hp):
+    """Fills in the names and tripcodes of the posts in tripv from the HTML
+    page hp, and returns them ready to be inserted, or None if hp doesn't
+    make sense."""
 
-        if verify_trips and len(tripv) > 0:
-            tripv_url = read_url + thread[0] + '/'
-            if len(tripv) < 200:
-                tripv_url += ','.join(tripv)
-            try:
-                hp = urlopen(tripv_url)
+    posts, htrips = [], {}
 
-            except:
-                error("Couldn't access HTML interface to verify tripcodes. " +
-                      "Skipping %s." % thread[0])
-                continue
+    # Every post header on the page, as {post: (author, trip)}
+    with timed('trip verify'):
+        for m in htripregex.finditer(hp):
+            htrips[m.group('id')] = m.group('author', 'trip')
 
+    for post, p in tripv.iteritems():
+        if post not in htrips:
+            error("Malformed post header for %s! Skipping thread." %
+                  (read_url + thread[0] + '/' + post))
+            return None
 
-        # Verify trips if needed, insert data
+        p['name'], p['trip'] = htrips[post]
 
-        for post in page:
-            p = page[post]
+        row = json_row(thread, post, p)
+        if row is not None:
+            posts.append(row)
 
-            if verify_trips and post in tripv:
-                htripper = re.compile(htripregex % (post, post), re.DOTALL)
-                m = htripper.search(hp)
+    return add_plaintext(posts)
 
-                if m is None:
-                    error("Malformed post header for %s! Exiting." %
-                          (read_url + thread[0] + '/' + post))
-                    sys.exit(1)
+def scrape_json(thread, parse=apply):
+    url = json_url + thread[0] + '/%d-%s' % (thread[2], thread[3] or '')
 
-                else:
-                    p['name'], p['trip'] = m.group('author'), m.group('trip')
+    # Parsed right here, the page is decoded as it comes in; parsers elsewhere
+    # get all of it at once
+    try:
+        if parse is apply:
+            page = urlopen_if_modified(url,
+                                       lambda chunks: parse_json(thread, chunks))
+        else:
+            page = urlopen_if_modified(url)
+    except ValueError:
+        raise ScrapeError("Can't parse JSON, thread %s skipped." % thread[0])
+    except:
+        raise ScrapeError("Can't access %s, thread skipped." %
+                          (json_url + thread[0]))
 
-            if not no_aborn or p['name'] != u'SILENT!ABORN' or \
-                               p['com'] != u'SILENT' or \
-                               p['now'] != u'1234':
+    if page is None:
+        # Unchanged since we last got it, so we already have it all
+        return ((unicode(thread[1]), unicode(thread[0])), [], url)
 
-                posts.append(map(lambda s: unicode(s, charset, "replace") \
-                                          if type(s) == str else s,
-                             (thread[0], post,
-                              p['name'], p['meiru'], p['trip'],
-                              p['now'], p['com'])))
+    if parse is apply:
+        posts, tripv = page
+    else:
+        try:
+            posts, tripv = parse(parse_json, (thread, [page]))
+        except ValueError:
+            raise ScrapeError("Can't parse JSON, thread %s skipped." %
+                              thread[0])
 
-        done_queue.put(((unicode(thread[1]), unicode(thread[0])), posts))
+    if tripv:
+        # Fetch only the posts we need, tripv_chunk at a time
+        ids = sorted(tripv, key=int)
+        try:
+            hp = ''.join(urlopen(read_url + thread[0] + '/' +
+                                 ','.join(ids[i:i + tripv_chunk]),
+                                 stage='trip fetch').content
+                         for i in xrange(0, len(ids), tripv_chunk))
 
+        except:
+            raise ScrapeError("Couldn't access HTML interface to verify " +
+                              "tripcodes. Skipping %s." % thread[0])
 
-def scrape_html():
-    global todo_queue, done_queue
+        verified = parse(verify_json_trips, (thread, tripv, hp))
+        if verified is None:
+            return None
+        posts.extend(verified)
 
-    postregex = u"""\
-<h3><span class="postnum"><a href='javascript:quote\((?P<id>\d+),"post1"\);'>(?P=id)</a> </span><span class="postinfo"><span class="namelabel"> Name: </span><span class="postername">(?P<author>.*?)</span><span class="postertrip">(?P<trip>.*?)</span> : <span class="posterdate">(?P<time>.*?)</span> <span class="id">.*?</span></span></h3>
-<blockquote>
-\t(?:<div class="aa">)?<p>
-(?P<body>.*?)
-\t</p>(?:</div>)?
-"""
-    postregex = re.compile(postregex, re.DOTALL)
+    return ((unicode(thread[1]), unicode(thread[0])), posts, url)
 
-    meiruregex = u'<a href="mailto:(?P<meiru>.*?)">(?P<rest>[^<]*)</a>'
-    meiruregex = re.compile(meiruregex)
 
-    while not todo_queue.empty():
-        try:
-            thread, posts = todo_queue.get(timeout=2), []
-        except:
-            continue
+# Post times on HTML pages are local time, to the minute. strptime is slow,
+# so they're parsed by hand when they look the way they always do, and
+# anything else goes through strptime to be taken or turned down the same as
+# ever. Busy threads have a lot of posts from the same minute, so results are
+# kept too, up to a point.
+post_time_regex = re.compile(r'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d)\Z')
+post_times = {}
+max_post_times = 10000
 
-        try:
-            page = urlopen(read_url + thread[0] + '/%d-' % thread[2])
-        except:
-            error("Can't access %s, skipping thread." % (read_url + thread[0]))
-            continue
-    
-        ids, authors, emails, trips, times, bodies = [], [], [], [], [], []
+def post_time(s):
+    """The Unix time of a post time from the HTML interface, like
+    time.mktime(time.strptime(s, "%Y-%m-%d %H:%M"))."""
 
-        erred = False
+    try:
+        return post_times[s]
+    except KeyError:
+        pass
+
+    m = post_time_regex.match(s)
+    if m is not None:
+        y, mon, d, h, mi = map(int, m.groups())
+
+    if m is not None and y >= 1900 and 1 <= mon <= 12 and h < 24 and \
+       mi < 60 and 1 <= d and (d <= 28 or d <= calendar.monthrange(y, mon)[1]):
+        # mktime ignores the day of the week and of the year
+        t = int(time.mktime((y, mon, d, h, mi, 0, 0, 1, -1)))
+    else:
+        t = int(time.mktime(time.strptime(s, "%Y-%m-%d %H:%M")))
+
+    if len(post_times) >= max_post_times:
+        post_times.clear()
+    post_times[s] = t
+    return t
+
+def html_posts(chunks):
+    """Splits an HTML thread page that comes in chunks into posts, yielding
+    each one (and then whatever comes after the last) as soon as it's all
+    there. It's split before it's decoded, which is fine in any charset a
+    board would use: none of them have a '<' in the middle of a character."""
+
+    buf = ''
+    for chunk in chunks:
+        buf, start = buf + chunk, 0
+        while True:
+            end = buf.find('</blockquote>', start)
+            if end < 0:
+                break
+            yield buf[start:end]
+            start = end + len('</blockquote>')
+        buf = buf[start:]
+
+    yield buf
+
+def parse_html(thread, chunks):
+    """Parses an HTML thread page, in chunks as it comes in, a post at a
+    time. Returns the posts from thread[2] on, ready to be inserted; those
+    before it (the first post is always there) are skipped before anything
+    else is done with them."""
+
+    posts, erred = [], False
+
+    # When the page is streamed, this includes waiting for the rest of it
+    with timed('html parse'):
+        for p in html_posts(chunks):
+            m = postnumregex.search(p)
+            if m is not None and int(m.group(1)) < thread[2]:
+                continue
 
-        for p in re.split('</blockquote>', unicode(page, charset, 'replace')):
-            m = postregex.search(p)
+            m = postregex.search(unicode(p, charset, 'replace'))
             if m is None:
                 if erred:
                     error("Broken post in thread %s" % thread[0])
                 erred = True
                 continue
 
-            ids.append(m.group('id'))
+            author, email, trip = m.group('author'), u'', m.group('trip')
 
-            meiru = False
-            mm = meiruregex.match(m.group('author'))
+            mm = meiruregex.match(author)
             if mm is not None:
-                authors.append(mm.group('rest'))
-                emails.append(mm.group('meiru'))
-                meiru = True
+                author, email = mm.group('rest', 'meiru')
             else:
-                authors.append(m.group('author'))
+                mm = meiruregex.match(trip)
+                if mm is not None:
+                    trip, email = mm.group('rest', 'meiru')
 
-            mm = meiruregex.match(m.group('trip'))
-            if not meiru and mm is not None:
-                trips.append(mm.group('rest'))
-                emails.append(mm.group('meiru'))
-                meiru = True
-            else:
-                trips.append(m.group('trip'))
+            posts.append([unicode(thread[0]), m.group('id'), author, email,
+                          trip,
+                          post_time(m.group('time')),
+                          m.group('body')])
 
-            if not meiru:
-                emails.append('')
+    return add_plaintext(posts)
 
-            times.append(int(time.mktime(time.strptime(m.group('time'),
-                                                       "%Y-%m-%d %H:%M"))))
+def scrape_html(thread, parse=apply):
+    url = read_url + thread[0] + '/%d-%s' % (thread[2], thread[3] or '')
 
-            bodies.append(m.group('body'))
-    
-        for post in zip(ids, authors, emails, trips, times, bodies):
-            if int(post[0]) >= thread[2]:
-                b = [unicode(thread[0])]
-                
-                for y in post:
-                    if type(y) == str:
-                        b.append(unicode(y, charset, 'replace'))
-                    else:
-                        b.append(y)
+    # Parsed right here, the page is parsed as it comes in; parsers elsewhere
+    # get all of it at once
+    try:
+        if parse is apply:
+            page = urlopen_if_modified(url,
+                                       lambda chunks: parse_html(thread, chunks))
+        else:
+            page = urlopen_if_modified(url)
+    except:
+        raise ScrapeError("Can't access %s, skipping thread." %
+                          (read_url + thread[0]))
+
+    if page is None:
+        # Unchanged since we last got it, so we already have it all
+        return ((unicode(thread[1]), unicode(thread[0])), [], url)
+
+    if parse is apply:
+        posts = page
+    else:
+        posts = parse(parse_html, (thread, [page]))
+
+    return ((unicode(thread[1]), unicode(thread[0])), posts, url)
+
+
+# Parsing in separate processes, so it isn't held back by the GIL. Processes
+# have their own error counts and stats, so those are sent back along with the
+# result.
+
+def parse_counting_errors(f, args):
+    global errors, stage_times, stage_counts
+
+    errors, stage_times, stage_counts = 0, {}, {}
+    return f(*args), errors, stage_times, stage_counts
+
+def parse_in_pool(f, args):
+    global errors
+
+    result, errs, times, counts = parse_pool.apply(parse_counting_errors,
+                                                   (f, args))
+    errors += errs
+    merge_stats(times, counts)
+    return result
+
+parse_stage, parse_pool = apply, None
+
+def start_parsers():
+    global parse_stage, parse_pool
+
+    if parsers != 0 and multiprocessing is not None:
+        try:
+            parse_pool = multiprocessing.Pool(parsers if parsers > 0 else None,
+                                              ignore_sigint)
+            parse_stage = parse_in_pool
+        except:
+            print "Can't start parser processes! Parsing in scraper threads."
+
+
+# Engines. They run scrapers on everything in todo_queue and put the results
+# on done_queue; the thread running an engine is alive until it's done.
+# Every thread taken off todo_queue is marked done there once it's dealt with,
+# so todo_queue.join() returns when there's nothing left to do; the threads
+# engine's workers then get a None each, to tell them to stop.
+# A thread that fails goes back on todo_queue, after a while, up to requeues
+# times; requeued counts how often each has so far. Chunks of a thread are
+# counted separately, as each can fail on its own.
+
+requeued = {}
+
+def scrape_thread(scrape, thread, parse):
+    if stopping.isSet():
+        return
+
+    try:
+        result = scrape(thread, parse)
+    except ScrapeError, e:
+        tries = requeued.get(thread, 0)
+        if tries >= requeues or stopping.isSet():
+            error(e.args[0])
+            return
+
+        requeued[thread] = tries + 1
+        count('requeued')
+        sleep(backoff(tries))
+        todo_queue.put(thread)
+        return
+
+    if result is not None:
+        done_queue.put(result)
+
+def scrape_and_mark(scrape, thread, parse):
+    try:
+        scrape_thread(scrape, thread, parse)
+    except:
+        error("Couldn't scrape %s: %s" % (thread[0], sys.exc_info()[1]))
+    todo_queue.task_done()
+
+def thread_engine(scrape):
+    while True:
+        thread = todo_queue.get()
+        if thread is None:
+            break
+
+        scrape_and_mark(scrape, thread, parse_stage)
+
+def async_engine(scrape, greenlets):
+    global connection_slots
+
+    # Parsing is left to gevent's pool of real threads, so it doesn't hold up
+    # the event loop; fetching is done by at most `greenlets' greenlets at
+    # once, sharing host_connections connections.
+    pool, threadpool = gevent.pool.Pool(greenlets), gevent.get_hub().threadpool
+    parse = lambda f, args: threadpool.apply(parse_stage, (f, args))
+    connection_slots = gevent.lock.BoundedSemaphore(host_connections)
+
+    # Go round again for whatever was requeued
+    while not todo_queue.empty():
+        while True:
+            try:
+                thread = todo_queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            pool.spawn(scrape_and_mark, scrape, thread, parse)
 
-                posts.append(b)
-        
-        done_queue.put(((unicode(thread[1]), unicode(thread[0])), posts))
+        pool.join()
 
+def close_queues(scrapers, sentinels):
+    """Stops the scrapers once every thread has been dealt with, and tells
+    the writer once they have."""
 
-# Spawn threads
+    todo_queue.join()
+    for _ in xrange(sentinels):
+        todo_queue.put(None)
 
-if threads < 1:
-    threads = min(tot, 1000) * 31 / 1000 + 1
+    for scraper in scrapers:
+        scraper.join()
+    done_queue.put(None)
 
-if tot < threads:
-    threads = tot
+def tick(until):
+    """Wakes the writer up every second until told to stop, so it can commit
+    batches and stats on time, and notice Ctrl-C. (Waiting on a queue with a
+    timeout would do that too, but Python 2 does it by napping and checking,
+    so the writer would be late for every page.)"""
 
-for _ in xrange(threads):
-    threading.Thread(target=scrape_json if use_json else scrape_html).start()
+    while True:
+        # (wait() only says whether it was set from Python 2.7 on)
+        until.wait(1)
+        if until.isSet():
+            break
+        done_queue.put(False)
 
+def interrupt(signum, frame):
+    print "Interrupted! Writing what we have; Ctrl-C again to quit now."
+    stopping.set()
+    signal.signal(signal.SIGINT, signal.default_int_handler)
 
-# Add scraped content to DB and possibly index as we're going
+def start_async():
+    global session, sleep
+
+    # Sockets made from here on cooperate with gevent. We need a fresh session
+    # for that, which also gets to keep all of its connections alive.
+    gevent.monkey.patch_socket()
+    session = new_session()
+    sleep = gevent.sleep
+
+
+# Add scraped content to DB and possibly index as we're going.
+# Posts are written in batches, one transaction per batch; a thread's last_post
+# is updated in the same transaction as its posts, so it's never ahead of them.
 
 def show_progress(idx, tot):
     perc = idx * 100.0 / tot
@@ -623,50 +1732,463 @@ def show_progress(idx, tot):
 
     print '\033[1AScraping... [%s] %.2f%% (%d/%d)' % (bars, perc, idx, tot)
 
-idx = 0
+# With a write-ahead log, SQLite copies what's committed back into the DB
+# every so often by itself, but only as far as readers let it, so a busy DB
+# can keep the log growing for as long as a scrape lasts. We have a go at it
+# every checkpoint_interval seconds as well, and once more at the end, when
+# the log is emptied out too if nobody's reading. We never wait for readers.
+last_checkpoint = time.time()
+
+def checkpoint(mode='passive'):
+    global last_checkpoint
+
+    if db_wal:
+        with timed('db checkpoint'):
+            timeout = db.execute('pragma busy_timeout').fetchone()[0]
+            db.execute('pragma busy_timeout = 0')
+            db.execute('pragma wal_checkpoint(%s)' % mode).fetchall()
+            db.execute('pragma busy_timeout = %d' % timeout)
+    last_checkpoint = time.time()
+
+def update_thread_stats(threads):
+    """Counts the posts in threads that thread_stats hasn't yet."""
+
+    for thread in threads:
+        posts, posters, first, last, last_id = db.execute(
+            'select posts, posters, first_time, last_time, last_id \
+             from thread_stats where thread = ?', (thread,)).fetchone() or \
+            (0, 0, None, None, 0)
+
+        new, new_first, new_last, new_last_id = db.execute(
+            'select count(*), min(time), max(time), max(id) from posts \
+             where thread = ? and id > ?', (thread, last_id)).fetchone()
+        if new == 0:
+            continue
 
-if tot > 0 and progress_bar:
-    print
-    show_progress(idx, tot)
+        db.execute("insert or ignore into thread_posters \
+                    select thread, coalesce(author, ''), coalesce(trip, '') \
+                    from posts where thread = ? and id > ?", (thread, last_id))
+        posters += db.rowcount
+
+        db.execute('insert or replace into thread_stats \
+                    values (?, ?, ?, ?, ?, ?)',
+                   (thread, posts + new, posters,
+                    new_first if first is None else min(first, new_first),
+                    max(last, new_last), new_last_id))
+
+def commit_batch(batch):
+    if len(batch) == 0:
+        return
+
+    with timed('db insert'):
+        db.executemany(u'insert or replace into posts \
+                         (thread, id, author, email, trip, time, body, \
+                          plain_body, plain_author) \
+                         values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (post for thread, posts, url in batch for post in posts))
+        db.executemany(u'update threads set last_post = ? where thread = ?',
+                       (thread for thread, posts, url in batch))
+        db.executemany(u"update journal set state = 'committed' \
+                         where thread = ?",
+                       ((thread[1],) for thread, posts, url in batch))
+        save_validators(url for thread, posts, url in batch)
+
+    if stats_table:
+        with timed('thread stats'):
+            update_thread_stats(set(thread[1] for thread, posts, url in batch
+                                              if len(posts) > 0))
 
-while threading.activeCount() > 1 or not done_queue.empty():
-    try:
-       thread, posts = done_queue.get(timeout=2)
-    except:
-        continue
+    if idir is not None:
+        with timed('index add'):
+            for thread, posts, url in batch:
+                if len(posts) > 0:
+                    index_posts(posts)
+
+    with timed('db commit'):
+        db_conn.commit()
+
+    if time.time() - last_checkpoint >= checkpoint_interval:
+        checkpoint()
+
+    if idir is not None and (ix_posts >= index_batch_size or
+                             time.time() - ix_start >= index_batch_time):
+        commit_index()
+
+    count('threads written', len(batch))
+    count('posts written', sum(len(posts) for thread, posts, url in batch))
+
+stats_flushed = time.time()
+
+def split(todo, chunk_size):
+    """Splits the threads in todo, as ((id, last_post, first post to fetch),
+    approx. posts), into pieces of work for the scrapers, biggest threads
+    first. Threads with more than chunk_size posts to fetch are split into
+    chunks that can be fetched side by side, and are queued one after the
+    other, so the thread is done (and can be written) as soon as possible;
+    returns the pieces and {thread ID: chunks} for those."""
+
+    work, chunks = [], {}
+
+    for thread, posts in sorted(todo, key=lambda t: -t[1]):
+        n = 1
+        if chunk_size > 0 and posts > chunk_size:
+            n = chunks[thread[0]] = (posts + chunk_size - 1) / chunk_size
+
+        for i in xrange(n):
+            first = thread[2] + i * chunk_size
+            last = first + chunk_size - 1 if i < n - 1 else None
+            work.append(thread[:2] + (first, last))
+
+    return work, chunks
+
+def run(todo):
+    """Scrapes the threads in todo, as ((id, last_post, first post to fetch),
+    approx. posts), and writes their posts as they come in."""
+
+    global stats_flushed
+
+    if len(todo) == 0:
+        return
+
+    # With the biggest threads going first, and big threads split up, the
+    # run doesn't end with one scraper going through a huge thread while the
+    # rest sit idle, and a failed fetch only costs a chunk's worth of posts
+    # to fetch again, however many scrapers there are. Chunks are only
+    # written once we have the whole thread, so its posts and last_post are
+    # still committed together; a thread's chunks are fetched together, so
+    # there are only ever a few threads waiting for theirs.
+    todo, chunks = split(todo, chunk_size)
+    parts = {}
+    tot = len(todo)
+
+    # Chunks count as work to share out, too
+    if engine == 'async':
+        workers = threads if threads >= 1 else min(tot, 1000)
+    else:
+        workers = threads if threads >= 1 else \
+                  min(tot, 1000) * 31 / 1000 + 1
 
-    db.execute(u'update threads set last_post = ? where thread = ?', thread)
+    requeued.clear()
 
-    if idir is not None:
-        ixwriter = ix.writer()
+    if use_json and not json_checked:
+        check_json(todo[0][0])
+
+    for thread in todo:
+        todo_queue.put(thread)
+
+    scrape = scrape_json if use_json else scrape_html
+
+    if engine == 'async':
+        scrapers = [threading.Thread(target=async_engine,
+                                     args=(scrape, min(workers, tot)))]
+        sentinels = 0
+    else:
+        scrapers = [threading.Thread(target=thread_engine, args=(scrape,))
+                    for _ in xrange(min(workers, tot))]
+        sentinels = len(scrapers)
+
+    # Scrapers are left behind if we have to quit right away
+    finished = threading.Event()
+    closer = threading.Thread(target=close_queues, args=(scrapers, sentinels))
+    ticker = threading.Thread(target=tick, args=(finished,))
+    for t in scrapers + [closer, ticker]:
+        t.setDaemon(True)
+        t.start()
+
+    signal.signal(signal.SIGINT, interrupt)
+
+    idx = 0
+    batch, batch_posts, batch_start = [], 0, time.time()
+
+    if progress_bar:
+        print
+        show_progress(idx, tot)
 
-    for post in posts:
-        db.execute(u'insert or replace into posts \
-                     (thread, id, author, email, trip, time, body) \
-                     values (?, ?, ?, ?, ?, ?, ?)', post)
-        if idir is not None:
+    while True:
+        # The next page, or False from the ticker
+        result = done_queue.get()
+        if result is None:
+            # That's everything
+            break
+
+        thread = None
+        if result:
+            thread, posts, url = result
+
+            idx += 1
+            if progress_bar:
+                show_progress(idx, tot)
+            else:
+                print "[%d/%d] Done thread %s." % (idx, tot, thread[1])
+
+            if thread[1] in chunks:
+                parts.setdefault(thread[1], []).append((posts, url))
+                if len(parts[thread[1]]) < chunks[thread[1]]:
+                    thread = None
+                else:
+                    # Only the last chunk's URL is worth remembering
+                    posts, urls = [], []
+                    for chunk_posts, chunk_url in parts.pop(thread[1]):
+                        posts.extend(chunk_posts)
+                        urls.append(chunk_url)
+                    for chunk_url in urls:
+                        if chunk_url[-1] != '-':
+                            fetched_validators.pop(chunk_url, None)
+                        else:
+                            url = chunk_url
+
+        if thread is not None:
+            if len(batch) == 0:
+                batch_start = time.time()
+            batch.append((thread, posts, url))
+            batch_posts += len(posts)
+
+        if batch_posts >= batch_size or \
+           len(batch) > 0 and time.time() - batch_start >= batch_time:
+            commit_batch(batch)
+            batch, batch_posts = [], 0
+
+        sample_queues()
+        if stats_file is not None and \
+           time.time() - stats_flushed >= stats_interval:
+            write_stats_file()
+            stats_flushed = time.time()
+
+    commit_batch(batch)
+    finished.set()
+    ticker.join()
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    # Threads some of whose chunks failed aren't written at all
+    for tid in parts:
+        for chunk_posts, chunk_url in parts[tid]:
+            fetched_validators.pop(chunk_url, None)
+
+
+# Watching the board. subject.txt is polled every watch_min to watch_max
+# seconds: more often while threads keep changing, less often while nothing
+# happens. A thread that changed is fetched after watch_delay times as long as
+# it had been quiet before (at most watch_max seconds), so busy threads are
+# fetched right away, and threads that wake up after a long time get to
+# collect a few replies first. Everything stays open in between.
+
+def watch_board():
+    global stats_flushed
+
+    subject_url = prog_url + 'subject.txt'
+    interval, next_poll = watch_min, time.time()
+    pending = {}    # {thread ID: (when to fetch it, thread, approx. posts)}
+
+    while True:
+        now = time.time()
+
+        if now >= next_poll:
             try:
-                timestamp = float(post[5])
+                subjecttxt = urlopen_if_modified(subject_url)
             except:
-                timestamp = 0.0
-            ixwriter.add_document(thread=int(post[0]), post=int(post[1]),
-                                  author=scrub(post[2]), email=post[3],
-                                  trip=post[4],
-                                  time=datetime.fromtimestamp(timestamp),
-                                  body=scrub(post[6]))
+                error("Can't fetch subject.txt, trying again later.")
+                subjecttxt = None
+
+            changed = 0
+            if subjecttxt is not None:
+                # Don't fetch it again until it changes, but don't remember
+                # that in the DB until we have everything it told us about
+                if subject_url in fetched_validators:
+                    validators[subject_url] = fetched_validators[subject_url]
+
+                for thread, posts, quiet in plan(subjecttxt):
+                    due = now + min(quiet * watch_delay, watch_max)
+                    if thread[0] in pending:
+                        if pending[thread[0]][1][1] != thread[1]:
+                            changed += 1
+                        due = min(due, pending[thread[0]][0])
+                    else:
+                        changed += 1
+                    pending[thread[0]] = (due, thread, posts)
+                db_conn.commit()
 
-    db_conn.commit()
+            if changed > 0:
+                interval = max(interval / 2, watch_min)
+            else:
+                interval = min(interval * 2, watch_max)
+            next_poll = now + interval
+
+        todo = [(thread, posts) for due, thread, posts in pending.values()
+                                if due <= now]
+        if len(todo) > 0:
+            for thread, posts in todo:
+                del pending[thread[0]]
+
+            print "%s: %d thread%s to update." % \
+                  (time.strftime('%Y-%m-%d %H:%M:%S'), len(todo),
+                   '' if len(todo) == 1 else 's')
+
+            errs, written = errors, stage_counts.get('posts written', 0)
+            run(todo)
+            written = stage_counts.get('posts written', 0) - written
+
+            if stopping.isSet():
+                return
+
+            if errors > errs:
+                # Get all of subject.txt next time, to find what we missed
+                validators.pop(subject_url, None)
+                fetched_validators.pop(subject_url, None)
+            elif len(pending) == 0:
+                save_validators([subject_url])
+                db_conn.commit()
+
+            print "Wrote %d post%s." % (written, '' if written == 1 else 's')
+
+            if stats_file is not None:
+                write_stats_file()
+                stats_flushed = time.time()
+
+        # Posts left in the index writer get committed on time, even if
+        # nothing else comes along
+        wakes = [next_poll] + [due for due, thread, posts in pending.values()]
+        if idir is not None and ixwriter is not None:
+            if time.time() - ix_start >= index_batch_time:
+                commit_index()
+            else:
+                wakes.append(ix_start + index_batch_time)
+
+        time.sleep(max(min(wakes) - time.time(), 0))
+
+
+def finish(wrote):
     if idir is not None:
-        ixwriter.commit()
+        commit_index(merge=True)
 
-    idx += 1
-    if progress_bar:
-        show_progress(idx, tot)
+    if parse_pool is not None:
+        parse_pool.close()
+
+    if db_profile == 'bulk':
+        add_extras()
+
+    db_conn.commit()
+    checkpoint('truncate')
+
+    if wrote:
+        written = stage_counts.get('posts written', 0)
+        print "Wrote %d post%s to the DB in %.2fs." % \
+              (written, '' if written == 1 else 's',
+               sum(stage_times[stage][1] for stage in ('db insert', 'db commit')
+                                         if stage in stage_times))
+
+    # Stopping is all that Ctrl-C is for when watching
+    interrupted = stopping.isSet() and not watch
+
+    if interrupted:
+        print "Interrupted! Stopped with %d error%s." % \
+              (errors, "" if errors == 1 else "s")
     else:
-        print "[%d/%d] Done thread %s." % (idx, tot, thread[1])
+        print "All done! Finished with %d error%s." % \
+              (errors, "" if errors == 1 else "s")
+
+    if stats_summary:
+        show_stats()
+
+    if stats_file is not None:
+        write_stats_file()
+
+    if interrupted and partial:
+        print "Run /prog/scrape again with the same threads to fetch the " \
+              "rest of them."
+    elif interrupted:
+        print "Run /prog/scrape with \033[1m--resume\033[0m to fetch the " \
+              "threads it didn't get to."
+    elif errors > 0:
+        print "It's possible that running /prog/scrape again will retrieve " \
+              "posts that couldn't\nbe retrieved just now."
+
+
+# Keep watching the board, if asked
+
+if watch:
+    print "Watching %s%s; hit Ctrl-C to stop." % (base_url, prog_url)
+
+    start_parsers()
+    if engine == 'async':
+        start_async()
+
+    try:
+        watch_board()
+    except KeyboardInterrupt:
+        print
+    finish(True)
+    sys.exit(0)
+
+
+# Otherwise, pick up where the last run left off if asked, or try to fetch
+# subject.txt
+
+if resume:
+    to_update, planned = read_journal()
+
+    if planned == 0:
+        print "Nothing to resume."
+        if db_profile == 'bulk':
+            add_extras()
+        sys.exit(0)
+
+    print "Resuming the last run: %d of %d thread%s left." % \
+          (len(to_update), planned, '' if planned == 1 else 's')
+
+else:
+    print "Fetching subject.txt...",
+    sys.stdout.flush()
+
+    try:
+        subjecttxt = urlopen_if_modified(prog_url + 'subject.txt')
+    except:
+        print "Can't find it! Exiting."
+        raise
+
+    if subjecttxt is None:
+        print "Not modified."
+        print "0 threads to update (approx. 0 posts)."
+        if db_profile == 'bulk':
+            add_extras()
+        sys.exit(0)
+
+    print "Got it."
+
+    partial_threads = "".join(sys.stdin.readlines()).split() if partial \
+                      else None
+    to_update = plan(subjecttxt, partial_threads)
+
+    if partial and len(to_update) != len(partial_threads):
+        print "Some of the threads you listed either don't need updating or",\
+              "don't exist:"
+
+        updating = set(thread[0] for thread, posts, quiet in to_update)
+        for thread in partial_threads:
+            if thread not in updating:
+                print " ", thread
+
+tot = len(to_update)
+tot_posts = sum(posts for thread, posts, quiet in to_update)
+
+print "%d thread%s to update (approx. %d post%s)." % \
+      (tot, '' if tot == 1 else 's', tot_posts, '' if tot_posts == 1 else 's')
+
+if dry_run:
+    print "Dry run; exiting."
+    sys.exit(0)
+
+if not partial and not resume:
+    write_journal(to_update)
+
+if tot > 0:
+    start_parsers()
+    if engine == 'async':
+        start_async()
+
+run([(thread, posts) for thread, posts, quiet in to_update])
 
-print "All done! Finished with %d error%s." % (errors, "" if errors == 1 else "s")
+# Only remember subject.txt if we got everything it told us about
+if errors == 0 and not partial and not resume and not stopping.isSet():
+    save_validators([prog_url + 'subject.txt'])
 
-if errors > 0:
-    print "It's possible that running /prog/scrape again will retrieve posts "\
-          "that couldn't\nbe retrieved just now."
+finish(tot > 0)
@@ -25,6 +25,26 @@ __progscrape()
             COMPREPLY='auto'
             return 0
             ;;
+        --parsers)
+            COMPREPLY='auto'
+            return 0
+            ;;
+        --stats-format)
+            COMPREPLY=( $( compgen -W 'json prometheus' -- $cur ) )
+            return 0
+            ;;
+        --engine)
+            COMPREPLY=( $( compgen -W 'threads async' -- $cur ) )
+            return 0
+            ;;
+        --db-profile)
+            COMPREPLY=( $( compgen -W 'default online bulk' -- $cur ) )
+            return 0
+            ;;
+        --db-indexes)
+            COMPREPLY=( $( compgen -W 'all time trip author' -- $cur ) )
+            return 0
+            ;;
     esac
 
     if [[ "$cur" == -* ]]; then
@@ -34,7 +54,14 @@ __progscrape()
             --verify-trips --no-verify-trips \
             --base-url --port --board --charset \
             --aborn --no-aborn --partial --threads \
-            --dry-run --no-dry-run \
+            --batch-size --batch-time --chunk-size --engine --connections --parsers \
+            --rate --retries \
+            --db-profile --db-pragma --checkpoint-interval \
+            --db-indexes --thread-stats \
+            --stats --stats-file --stats-format \
+            --index --index-batch-size --index-batch-time \
+            --dry-run --no-dry-run --resume --backfill \
+            --watch --watch-min --watch-max \
             --help -h' -- $cur ) )
     elif [ ! -z $(type -t _filedir) ]; then
         _filedir db
@@ -0,0 +1,65 @@
+"""
+Turns the HTML Shiichan uses for post bodies and names into plain text, the
+way /prog/scrape stores it in plain_body and plain_author: line breaks become
+newlines, quotes are marked with '> ', other tags are dropped, and character
+references are decoded.
+
+This is shared by progscrape.py and the scripts in extra/, so put it next to
+progscrape.py.
+"""
+
+import re
+from htmlentitydefs import name2codepoint
+
+
+# Tags can't span lines; everything else between < and > goes.
+tag_regex = re.compile('<[^>\n]*>')
+
+# Character references. Numeric ones are decoded first, then named ones in
+# what that gives, as the old scrubber did, so that the text stays the same
+# where the first make the second (&#38;amp;, &amp&#59;, &&#97;mp; all
+# come out as &).
+numeric_regex = re.compile(r'&#(\d+);')
+named_regex = re.compile(r'&([A-Za-z0-9]+);')
+
+named = dict((u'&%s;' % name, unichr(cp))
+             for name, cp in name2codepoint.iteritems())
+
+# Decoded references, as {reference: text}. Posts use the same few over and
+# over, so this saves a lot of work; there's a limit in case someone posts
+# the whole of Unicode.
+decoded = {}
+max_decoded = 10000
+
+def decode(m):
+    ref = m.group(0)
+    try:
+        return decoded[ref]
+    except KeyError:
+        pass
+
+    if ref[1] == '#':
+        cp = int(m.group(1))
+        text = unichr(cp) if cp <= 0x10ffff else ref
+    else:
+        text = named.get(ref, ref)
+
+    if len(decoded) < max_decoded:
+        decoded[ref] = text
+    return text
+
+def scrub(s):
+    """Plain text version of s, or u'' if it's None."""
+
+    if s is None:
+        return u''
+
+    if '<' in s:
+        s = tag_regex.sub('', s.replace('<br/>', '\n')
+                               .replace("<span class='quote'>", '> '))
+    if '&#' in s:
+        s = numeric_regex.sub(decode, s)
+    if '&' in s:
+        s = named_regex.sub(decode, s)
+
+    return s